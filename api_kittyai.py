@@ -1,17 +1,84 @@
 from plugins import api_google as api_google
 import core.api_openai as api_openai
-import json
-import os
+import copy
 import asyncio
-from dotenv import load_dotenv, dotenv_values
 import helpertools
+import os
 import re
+from core.storage import get_storage
+from core.request_context import RequestContext, count_storage_lookup
+from core.settings_records import ChannelSettings, UserSettings
+from core.summary_store import ThreadSummaryStore
+from core.response_cache import ResponseCache
+from core.single_flight import SingleFlight, SharedStream
+from core.rate_limiter import RateLimiter
+from core.usage_ledger import UsageLedger
+from core.key_validation import ValidationCache
+
+# shorten all links sent by assistant to only domain and domain extension. example: https://www.youtube.com/watch?v=ZE5zXLOyEOQ -> youtube.com/...
+link_pattern = re.compile(r'(https?://)?(www\.)?(?P<domain>[a-zA-Z0-9-]+)\.(?P<extension>[a-zA-Z0-9-]+)(\.[a-zA-Z0-9-]+)?(/.*)?')
+
+def shorten_links(previous_chat_history):
+    # returns the history with shortened links in the assistant messages (the given history is not changed)
+    return [
+        dict(entry,content=link_pattern.sub(r'\g<domain>.\g<extension>/...',entry["content"])) if entry["role"] == "assistant" else entry
+        for entry in previous_chat_history
+    ]
+
+def compact_message_history(previous_chat_history,max_tokens,model="gpt-3.5-turbo",keep_recent=1):
+    # prepares the history for summarizing, without changing the given history:
+    # links in assistant messages are shortened (to reduce tokens), the last keep_recent messages are not summarized,
+    # and the messages before them are added to a transcript ("role: content" lines), from the oldest one as long as they fit into max_tokens.
+    # All messages are tokenized in one batch and a running total is kept, so the cost per message stays the same for long histories.
+    # returns (transcript, most recent message, token counts), the token counts contain
+    # "messages" (tokens of the content of every message), "transcript" (tokens of the transcript)
+    # and "transcript_messages" (number of messages in the transcript, always the oldest ones)
+    entries = shorten_links(previous_chat_history)
+
+    lines = [entry["role"]+": "+entry["content"]+"\n" for entry in entries[:len(entries)-keep_recent]]
+    line_tokens = api_openai.count_tokens_batch(lines,model)
+    transcript = []
+    transcript_tokens = 0
+    for line, tokens in zip(lines,line_tokens):
+        # the transcript ends at the first message that doesn't fit, so a summary of it covers every message up to its last one
+        if transcript_tokens+tokens > max_tokens:
+            if transcript:
+                break
+            # a single message longer than max_tokens is cut, so the summary still moves forward
+            line = line[:len(line)*max_tokens//tokens]
+            tokens = max_tokens
+        transcript.append(line)
+        transcript_tokens += tokens
+
+    token_counts = {
+        "messages": api_openai.count_tokens_batch([entry["content"] for entry in entries],model),
+        "transcript": transcript_tokens,
+        "transcript_messages": len(transcript),
+        "summary": 0
+    }
+    return "".join(transcript), entries[-1], token_counts
+
+def pack_message_history(message_tokens,max_tokens):
+    # returns how many of the most recent messages fit into max_tokens, filled from the newest to the oldest message.
+    # message_tokens are the tokens of the content of every message (the formatting of each message is added).
+    # It stops at the first message that doesn't fit, so no message in between is left out
+    used_tokens = 0
+    count = 0
+    for tokens in reversed(message_tokens):
+        used_tokens += tokens+api_openai.tokens_per_message
+        if used_tokens > max_tokens:
+            break
+        count += 1
+    return count
+
 
 # this python class is used to process all the messages from the user, check if plugins are requested and calls them if needed
 
 class KittyAIapi:
-    def __init__(self,debug=False):
+    def __init__(self,debug=False,storage=None,thread_summaries=None,response_cache=None,usage_ledger=None,key_validations=None):
         self.debug = debug
+        # the model router prints which model it chose for every request only in debug mode
+        api_openai.router.debug = debug
         self.llm_prompt_precise = "You are a helpful assistant called KittyAI. Provide concise and helpful responses."
         self.llm_prompt_creative = "You are a helpful assistant called KittyAI."
         self.llm_prompt_plugins_intro = "Identify if the user asked to execute one or multiple of the following plugins or settings. If so, integrate the python function calls like \"function(parameters)\" in your response."
@@ -47,7 +114,12 @@ class KittyAIapi:
             "timezone": None,
             "language": "en",
             "llm_default_model": "OpenAI gpt-4",
-            "user_informed_about_missing_llm": False
+            "user_informed_about_missing_llm": False,
+            # monthly limits for the user, None for no limit (see check_budget)
+            "monthly_token_budget": None,
+            "monthly_cost_budget_eur": None,
+            # "downgrade" to a cheaper model or "refuse" to answer when the budget of the user is used up
+            "budget_exceeded_action": "refuse"
         }
         self.default_user_history = {
             "monthly_used_tokens": 0,
@@ -65,12 +137,43 @@ class KittyAIapi:
             "autorespond": True,
             "num_of_last_messages_included": 5,
             "plugins": self.available_plugins,
-            "debug_mode": False
+            "debug_mode": False,
+            # cache the answers of requests with creativity 0.0 (see get_llm_response)
+            "llm_response_cache": False,
+            # monthly limits for the channel, None for no limit (see check_budget)
+            "monthly_token_budget": None,
+            "monthly_cost_budget_eur": None,
+            # "downgrade" to a cheaper model or "refuse" to answer when a budget is used up
+            "budget_exceeded_action": "downgrade"
         }
+        # the defaults are shared by all settings records, which only store what differs from them
+        ChannelSettings.set_defaults(self.default_channel_settings,log=self.log)
+        UserSettings.set_defaults(self.default_user_settings,log=self.log)
         self.num_results_default = 4
-        self.default_user_secrets_folder = "user_secrets"
-        self.default_user_history_folder = "user_history"
-        self.default_user_settings_folder = "user_settings"
+        # space in the context window that is kept free for the answer when the history is packed (see ask),
+        # and the tokens estimated for the date and location line of the system prompt
+        self.llm_answer_reserved_tokens = 1000
+        self.system_prompt_extra_tokens = 50
+        # storage for settings, secrets and history. Selected via KITTYAI_STORAGE ("files" or "sqlite"), see core/storage.py
+        self.storage = storage or get_storage()
+        # rolling summaries of the threads (see shorten_message_history)
+        self.thread_summaries = thread_summaries or ThreadSummaryStore()
+        # answers of deterministic requests, only used in channels that enabled it (KITTYAI_RESPONSE_CACHE_PATH adds a disk tier)
+        self.response_cache = response_cache or ResponseCache(disk_path=os.getenv("KITTYAI_RESPONSE_CACHE_PATH"))
+        # LLM requests that are running, identical requests wait for them instead of being sent again
+        self.llm_requests = SingleFlight(name="LLM requests")
+        # tokens used per user, channel and model, saved to the user history in batches
+        self.usage_ledger = usage_ledger or UsageLedger(self.storage,self.default_user_history)
+        # results of API key checks per capability, so /setup_... doesn't check the same key again
+        self.key_validations = key_validations or ValidationCache()
+        # LLMs and plugins each user has all API keys for: {user_id: (user secrets, capabilities)}
+        # recalculated whenever the secrets of the user change
+        self.user_capabilities = {}
+        # channel settings after inheritance (thread -> channel -> guild -> defaults): {settings chain: (settings, settings channel id)}
+        # resolved_settings_dependents lists for every channel/guild which cached chains include it, to remove them when it changes
+        self.resolved_channel_settings = {}
+        self.resolved_settings_dependents = {}
+        self.max_resolved_channel_settings = 50000
         self.log("KittyAI API initialized")
     
     def log(self,message,failure=False):
@@ -81,6 +184,121 @@ class KittyAIapi:
                 print(message)
             print("--------")
 
+    def warm_up(self):
+        # load what would otherwise slow down the first message (blocking, run it in a thread)
+        try:
+            api_openai.warm_up_encodings()
+        except Exception as e:
+            self.log("warm_up(): could not load the tokenizer encodings: "+str(e),failure=True)
+
+    async def close(self):
+        # close the pooled HTTP connections when the bot stops (the stores save their changes at exit)
+        await api_openai.close_session()
+
+    #############################
+    ## LLM requests
+    #############################
+
+    async def get_llm_response(self,key,messages,temperature=0.0,model="OpenAI gpt-4",max_tokens=3000,use_cache=False,task="answer",user_id=None,channel_id=None,key_messages=None):
+        # like api_openai.get_llm_response, but
+        # answers of deterministic requests (temperature 0) are cached if use_cache is True,
+        # the key of the request is built from key_messages if given (e.g. the messages without the date and time of the system prompt),
+        # identical requests that run at the same time are only sent once (see core/single_flight.py),
+        # and the tokens used are counted for user_id and channel_id (see core/usage_ledger.py)
+        # task ("answer", "summarize" or "thread_name") selects the policy of the model router (see api_openai.task_policies)
+        request_key = ResponseCache.get_key(api_openai.model_names.get(model,model),temperature,key_messages or messages,max_tokens)
+        use_cache = use_cache and not temperature
+
+        if use_cache:
+            cached = await self.response_cache.get(request_key)
+            if cached:
+                self.log("get_llm_response(): answer from the response cache, hit rate "+str(round(self.response_cache.hit_rate(),2)))
+                return api_openai.LLMStream(
+                    api_openai.replay_stream(cached["text"],cached["usage"]),
+                    model=model,
+                    messages=messages,
+                    cached=True
+                )
+
+        # only requests with the same API key are coalesced, so every user's request is sent with their own key and quota
+        flight_key = (RateLimiter.hash_key(key),request_key)
+        shared_stream = await self.llm_requests.run(flight_key,self.start_llm_response,key,messages,temperature,model,max_tokens,task,request_key if use_cache else None,user_id,channel_id)
+        return shared_stream.subscribe()
+
+    async def start_llm_response(self,key,messages,temperature,model,max_tokens,task,cache_key=None,user_id=None,channel_id=None):
+        stream = await api_openai.get_llm_response(key,messages,temperature=temperature,model=model,max_tokens=max_tokens,task=task)
+        if user_id:
+            # the request that is sent is counted (for the user who started it), not the callers that join it
+            self.usage_ledger.track(stream,user_id,channel_id)
+        if cache_key and not stream.error:
+            async def save_to_cache(finished_stream):
+                # the key is made for the requested model, an answer of a fallback model (see api_openai.ModelRouter) is not cached
+                if finished_stream.content and finished_stream.model == api_openai.resolve_model(model):
+                    await self.response_cache.set(cache_key,finished_stream.content,finished_stream.usage)
+            stream.add_finish_callback(save_to_cache)
+        return SharedStream(stream)
+
+    def get_response_cache_stats(self):
+        return self.response_cache.get_stats()
+
+    async def get_model_report(self,user_id):
+        # latencies and error rates of the models used with the OpenAI key of the user (see api_openai.ModelRouter)
+        user_secrets = await self.storage.get_user_secrets(str(user_id))
+        key = user_secrets.get("OPENAI_API_KEY")
+        if not key:
+            return {}
+        # models the router only checked, without sending a request in the last minutes, are left out
+        return {name: stats for name, stats in api_openai.router.get_report(key).items() if stats["requests"]}
+
+    def get_usage(self,user_id=None,channel_id=None):
+        # tokens and costs of the current month since the bot started, for all users and channels if not given
+        return self.usage_ledger.get_usage(user_id=user_id,channel_id=channel_id)
+
+    async def get_month_usage(self,user_id):
+        # tokens and costs (EUR) of the user this month, including the usage saved before the bot started
+        user_id = str(user_id)
+        if user_id not in self.usage_ledger.loaded_users:
+            await self.usage_ledger.load_user(user_id)
+        return self.usage_ledger.get_month_usage(user_id=user_id)
+
+    def get_cheaper_model(self,model,capabilities):
+        # the cheapest model the user has access to that is cheaper than model, or None
+        price = api_openai.get_costs(1000,model)
+        cheaper_models = [llm for llm in self.supported_llm_models if llm in capabilities and api_openai.get_costs(1000,llm) < price]
+        return min(cheaper_models,key=lambda llm: api_openai.get_costs(1000,llm)) if cheaper_models else None
+
+    def check_budget(self,context,model):
+        # returns the model to use and an error message if the monthly budget of the user or the channel is used up.
+        # Only the counters in memory are used (see UsageLedger.get_month_usage), it doesn't read the storage.
+        # The bot checks the budget before it sends any request for a message, ask() then uses the model that passed the check
+        if model and context.budget_checked_model == model:
+            return model, None
+        # every budget has its own action ("downgrade" or "refuse") for when it is used up
+        budgets = [
+            ("Your", self.usage_ledger.get_month_usage(user_id=context.user_id), context.get_user_setting("monthly_token_budget"), context.get_user_setting("monthly_cost_budget_eur"), context.get_user_setting("budget_exceeded_action")),
+            ("This channel's", self.usage_ledger.get_month_usage(channel_id=context.channel_id), context.get_channel_setting("monthly_token_budget"), context.get_channel_setting("monthly_cost_budget_eur"), context.get_channel_setting("budget_exceeded_action"))
+        ]
+        used_up = [
+            (owner, usage, action) for owner, usage, token_budget, cost_budget, action in budgets
+            if (token_budget is not None and usage["tokens"] >= token_budget) or (cost_budget is not None and usage["cost_eur"] >= cost_budget)
+        ]
+        if not used_up:
+            context.budget_checked_model = model
+            return model, None
+
+        for owner, usage, action in used_up:
+            self.log("check_budget(): "+owner+" monthly budget is used up: "+str(usage["tokens"])+" tokens, "+str(round(usage["cost_eur"],2))+" EUR, action: "+str(action))
+        # a budget that refuses wins over one that downgrades
+        refused = [(owner, usage) for owner, usage, action in used_up if action != "downgrade"]
+        if not refused:
+            cheaper_model = self.get_cheaper_model(model,context.capabilities)
+            if cheaper_model:
+                self.log("check_budget(): using "+cheaper_model+" instead of "+str(model))
+                context.budget_checked_model = cheaper_model
+                return cheaper_model, None
+        owner, usage = refused[0] if refused else used_up[0][:2]
+        return model, "Error: "+owner+" monthly budget is used up ("+str(usage["tokens"])+" tokens, "+str(round(usage["cost_eur"],2))+" EUR this month). It is reset at the beginning of next month."
+
     #############################
     ## Process messages
     #############################
@@ -129,92 +347,122 @@ class KittyAIapi:
             api_key=None,
             llm_summarize_model="OpenAI gpt-3.5-turbo",
             llm_summarize_max_tokens=2000,
-            max_summary_length=500
+            max_summary_length=500,
+            max_unsummarized_tokens=1000,
+            thread_id=None,
+            channel_id=None,
+            max_history_tokens=None
             ):
+        # returns the shortened history and the token counts (see compact_message_history)
+        # with a thread_id, the summary is saved and only the messages after it are summarized next time.
+        # Messages are only summarized if the messages that are not summarized yet have more than max_unsummarized_tokens.
+        # With max_history_tokens (the space for the history in the context window of the model, see ask) they are only
+        # summarized if they don't fit into it. Then as many recent messages as fit are kept and only the older ones are summarized.
+        # The tokens used for the summary are counted for channel_id (the thread if not given).
         self.log("shorten_message_history(previous_chat_history="+str(previous_chat_history)+",llm_summarize_model="+llm_summarize_model+",llm_summarize_max_tokens="+str(llm_summarize_max_tokens)+")")
         
         if not previous_chat_history:
-            return previous_chat_history
+            return [], {"messages": [], "transcript": 0, "summary": 0, "shortened_history": 0}
         
         # check if user has access to summarize model
         if not api_key:
             api_key = await self.get_api_key(user_id,"OPENAI_API_KEY")
             if not api_key:
                 self.log("shorten_message_history(): No OpenAI API key found for user "+user_id,failure=True)
-                return previous_chat_history
+                token_counts = {"messages": api_openai.count_tokens_batch([entry["content"] for entry in previous_chat_history],llm_summarize_model), "transcript": 0, "summary": 0}
+                # without summarizing, only the most recent messages that fit are kept
+                keep = pack_message_history(token_counts["messages"],max_history_tokens) if max_history_tokens is not None else len(previous_chat_history)
+                token_counts["shortened_history"] = sum(token_counts["messages"][len(previous_chat_history)-keep:])
+                return list(previous_chat_history[len(previous_chat_history)-keep:]), token_counts
         
-        # Reduce tokens used:
-        # shorten all links sent by assistant to only domain and domain extension. example: https://www.youtube.com/watch?v=ZE5zXLOyEOQ -> youtube.com/...
-        summarize_this_chat_history = ""
-        most_recent_response = None
-        
-        # loop over history with counter
-        # TODO: from the last one backwards to the first one
-        for i,entry in enumerate(previous_chat_history):
-            try:
-                
-                if entry["role"] == "assistant":
-                    try:
-                        entry["content"] = re.sub(r'(https?://)?(www\.)?(?P<domain>[a-zA-Z0-9-]+)\.(?P<extension>[a-zA-Z0-9-]+)(\.[a-zA-Z0-9-]+)?(/.*)?', r'\g<domain>.\g<extension>/...', entry["content"])
-                        self.log("shorten_message_history(): shortened links: "+entry["content"])
-                    except:
-                        self.log("shorten_message_history(): error while shortening links: "+entry["content"],failure=True)
-                
-                # if the message is not the last one, add it to the full message history string
-                if i < len(previous_chat_history)-1:
-                    token_length = api_openai.count_tokens(entry["content"])
-                    self.log("shorten_message_history(): The message has "+str(token_length)+" tokens: "+entry["content"])
-                    if api_openai.count_tokens(summarize_this_chat_history)+token_length <= llm_summarize_max_tokens:
-                        summarize_this_chat_history += entry["role"]+": "+entry["content"]+"\n"
-                else:
-                    # else define it as the most recent message
-                    most_recent_response = entry
-
-            except Exception as e:
-                self.log("shorten_message_history(): error while shortening message: "+str(e),failure=True)
-        
-        full_message_history_token_length = api_openai.count_tokens(summarize_this_chat_history)
-        self.log("shorten_message_history(): The full history has now "+str(full_message_history_token_length)+" tokens: "+summarize_this_chat_history)
-        self.log("shorten_message_history(): Most_recent_response: "+str(most_recent_response))
+        # the messages after the saved summary of the thread (Discord message ids increase over time)
+        thread_summary = self.thread_summaries.get(thread_id) if thread_id else None
+        if thread_summary:
+            new_messages = [entry for entry in previous_chat_history if not entry.get("message_id") or int(entry["message_id"]) > int(thread_summary["message_id"])]
+            self.log("shorten_message_history(): Using the saved summary until message "+thread_summary["message_id"]+", "+str(len(new_messages))+" new messages")
+        else:
+            new_messages = list(previous_chat_history)
+        summary = thread_summary["summary"] if thread_summary else None
+        summary_tokens = thread_summary["tokens"] if thread_summary else 0
 
-        # if summarize_this_chat_history is setup, summarize it
-        summarized_history = None
-        if summarize_this_chat_history:
-            summarized_history, used_tokens = await api_openai.get_llm_response(
-                key = api_key,
-                messages = [
-                        {
-                            "role":"system",
-                            "content":self.llm_summarize_history_prompt
-                        },
-                        {
-                            "role":"assistant",
-                            "content":summarize_this_chat_history
-                        }
-                    ],
-                model = llm_summarize_model,
-                max_tokens = max_summary_length
-            )
+        new_messages = shorten_links(new_messages)
+        message_tokens = api_openai.count_tokens_batch([entry["content"] for entry in new_messages],llm_summarize_model)
+        token_counts = {"messages": message_tokens, "transcript": 0, "summary": summary_tokens}
 
-            self.log("shorten_message_history(): Summary: \n"+summarized_history)
-            self.log("shorten_message_history(): Used tokens (message+response):\n"+str(used_tokens))
-            # output how many tokens have been saved by summarizing
-            
-            cost = api_openai.get_costs(used_tokens,"gpt-3.5-turbo")
-            self.log("shorten_message_history(): Cost USD: \n"+str(cost))
+        # as long as the new messages are short (or fit into max_history_tokens), send them as they are (together with the saved summary) without summarizing
+        if max_history_tokens is None:
+            fits = sum(message_tokens[:-1]) <= max_unsummarized_tokens
         else:
+            fits = not new_messages or pack_message_history(([summary_tokens] if summary else [])+message_tokens,max_history_tokens) == len(message_tokens)+(1 if summary else 0)
+        if fits:
+            shortened_message_history = ([{"role":"assistant","content":summary,"summary":True}] if summary else []) + new_messages
+            token_counts["shortened_history"] = summary_tokens+sum(message_tokens)
             self.log("shorten_message_history(): No messages to summarize")
+            return shortened_message_history, token_counts
+
+        # else summarize the saved summary and the older new messages into a new summary.
+        # The most recent message is always kept, with max_history_tokens all recent messages that fit next to the summary
+        keep = 1
+        if max_history_tokens is not None:
+            keep = min(max(pack_message_history(message_tokens,max_history_tokens-max_summary_length-api_openai.tokens_per_message),1),max(len(new_messages)-1,1))
+        self.log("shorten_message_history(): Keeping the "+str(keep)+" most recent messages")
+        entries = ([{"role":"assistant","content":summary}] if summary else []) + new_messages
+        summarize_this_chat_history, most_recent_response, compact_token_counts = compact_message_history(
+            entries,
+            llm_summarize_max_tokens,
+            llm_summarize_model,
+            keep_recent=keep
+        )
+        token_counts["transcript"] = compact_token_counts["transcript"]
+        self.log("shorten_message_history(): The history to summarize has "+str(token_counts["transcript"])+" tokens: "+summarize_this_chat_history)
+        self.log("shorten_message_history(): Most_recent_response: "+str(most_recent_response))
+
+        summary_stream = await self.get_llm_response(
+            key = api_key,
+            messages = [
+                    {
+                        "role":"system",
+                        "content":self.llm_summarize_history_prompt
+                    },
+                    {
+                        "role":"assistant",
+                        "content":summarize_this_chat_history
+                    }
+                ],
+            model = llm_summarize_model,
+            max_tokens = max_summary_length,
+            task = "summarize",
+            user_id = user_id,
+            channel_id = channel_id or thread_id
+        )
+        summarized_history = await summary_stream.text()
+        used_tokens = summary_stream.tokens_used
+        token_counts["summary"] = summary_stream.usage["completion_tokens"]
+
+        self.log("shorten_message_history(): Summary: \n"+summarized_history)
+        self.log("shorten_message_history(): Used tokens (message+response):\n"+str(used_tokens))
+        cost = api_openai.get_costs(used_tokens,summary_stream.model)
+        self.log("shorten_message_history(): Cost USD: \n"+str(cost))
+
+        # save the summary, the next reply only needs to summarize the messages after the last summarized message
+        # (only the messages that went into the transcript, the ones that didn't fit are summarized next time)
+        summarized_messages = compact_token_counts["transcript_messages"]-(1 if summary else 0)
+        last_summarized_message = new_messages[summarized_messages-1] if summarized_messages > 0 else None
+        if thread_id and not summary_stream.error and last_summarized_message and last_summarized_message.get("message_id"):
+            self.thread_summaries.set(thread_id,last_summarized_message["message_id"],summarized_history,token_counts["summary"])
 
         # return summarized history 
-        shortened_message_history = [
+        shortened_message_history = ([
             {
                 "role":"assistant",
-                "content":summarized_history
-            },
-            most_recent_response
-        ] if summarized_history else [most_recent_response]
+                "content":summarized_history,
+                "summary":True
+            }
+        ] if summarized_history else []) + new_messages[-keep:]
+        # tokens of the shortened history (summary and most recent messages), so ask() doesn't need to count them again
+        token_counts["shortened_history"] = token_counts["summary"]+sum(message_tokens[-keep:])
 
-        return shortened_message_history
+        return shortened_message_history, token_counts
 
     async def ask(
             self,
@@ -226,49 +474,87 @@ class KittyAIapi:
             llm_main_creativity=None,
             llm_main_model=None,
             llm_summarize_model="gpt-3.5-turbo",
+            context=None
             ):
         self.log("ask(channel_id="+str(channel_id)+",user_id="+str(user_id)+",new_message="+str(new_message)+",previous_chat_history="+str(previous_chat_history)+")")
 
         # previous_chat_history (optional) is a list of dictionaries with the following keys: "role" ("user", or "assistant") and "content".
         # example: [{"role": "user", "content": "Hello!"}, {"role": "assistant", "content": "Hi!"}]
 
+        # the request context (see get_request_context) already contains the settings and keys, otherwise load them
+        if not context:
+            context = await self.get_request_context(user_id=user_id,channel_id=channel_id)
+
         # load channel settings to define creativity and model
         if not llm_main_creativity:
-            llm_main_creativity = await self.get_channel_settings(channel_id,"llm_creativity")
+            llm_main_creativity = context.get_channel_setting("llm_creativity")
             self.log("ask(): llm_main_creativity="+str(llm_main_creativity))
         if not llm_main_model:
-            llm_main_model = await self.get_channel_settings(channel_id,"llm_default_model")
+            llm_main_model = context.get_channel_setting("llm_default_model")
             self.log("ask(): llm_main_model="+str(llm_main_model))
 
-        # check if user has API keys to use OpenAI using get_api_key
-        open_ai_key = await self.get_api_key(user_id,"OPENAI_API_KEY")
+        # check if user has API keys to use OpenAI
+        open_ai_key = context.get_api_key("OPENAI_API_KEY")
         if not open_ai_key:
-            # if not, return error message
+            # if not, return error message (as a stream, like every response)
             message_output = "Error: No OpenAI API key found for your User ID."
             self.log("ask(): "+message_output,failure=True)
-            return message_output
-
-        # add system prompt message to message history before all other messages
-        system_prompt = await self.get_system_prompt(
-            user_id=user_id,
-            channel_id=channel_id,
-            usable_plugins=usable_plugins
+            return api_openai.LLMStream(text=message_output,error=True)
+
+        # check the monthly budgets before any tokens are used, a cheaper model may be used instead
+        llm_main_model, message_output = self.check_budget(context,llm_main_model)
+        if message_output:
+            return api_openai.LLMStream(text=message_output,error=True)
+
+        # the history gets the space the context window of the model leaves after the system prompt, the new message and the answer.
+        # The system prompt is not ready yet, it is estimated from the system prompt of the channel
+        system_prompt_tokens, new_message_tokens = api_openai.count_tokens_batch([context.get_channel_setting("llm_systemprompt") or self.llm_prompt_precise,new_message],llm_main_model)
+        max_history_tokens = (
+            api_openai.get_context_window(llm_main_model)
+            -self.llm_answer_reserved_tokens
+            -system_prompt_tokens-self.system_prompt_extra_tokens
+            -new_message_tokens
+            -2*api_openai.tokens_per_message
         )
-
-        self.log("ask(): system_prompt="+str(system_prompt))
-
-        # shorten history
-        message_history = await self.shorten_message_history(
-            previous_chat_history=previous_chat_history,
-            user_id=user_id,
-            api_key=open_ai_key,
-            llm_summarize_model=llm_summarize_model
+        self.log("ask(): max_history_tokens="+str(max_history_tokens))
+
+        # the system prompt and the shortened history don't depend on each other, prepare them at the same time.
+        # The date and time are added to the system prompt separately, so they are not part of the key of the response cache
+        date_time_prompt, system_prompt, (message_history, history_token_counts) = await asyncio.gather(
+            self.get_date_time_prompt(context.channel_id,context=context),
+            self.get_system_prompt(
+                user_id=user_id,
+                channel_id=context.channel_id,
+                usable_plugins=usable_plugins,
+                context=context,
+                date_time=False
+            ),
+            self.shorten_message_history(
+                previous_chat_history=previous_chat_history,
+                user_id=user_id,
+                api_key=open_ai_key,
+                llm_summarize_model=llm_summarize_model,
+                # the summary of a thread is saved for the thread the message was sent in
+                thread_id=context.message_channel_id,
+                channel_id=context.channel_id,
+                max_history_tokens=max(max_history_tokens,0)
             )
+        )
+
+        self.log("ask(): system_prompt="+str(date_time_prompt+system_prompt))
+        # the tokens of the history have already been counted while shortening it
+        prompt_tokens = history_token_counts["shortened_history"]+api_openai.count_tokens(date_time_prompt+system_prompt,llm_main_model)+new_message_tokens+api_openai.tokens_per_message*(len(message_history)+2)
+        # if the system prompt is longer than estimated, the oldest messages are left out so the answer still has enough space.
+        # The summary (always the first entry) covers the older messages, it is only left out after all the other messages
+        while message_history and api_openai.get_max_tokens(prompt_tokens,llm_main_model) < api_openai.min_answer_tokens:
+            left_out = message_history.pop(1 if len(message_history) > 1 and message_history[0].get("summary") else 0)
+            prompt_tokens -= api_openai.count_tokens(left_out["content"],llm_main_model)+api_openai.tokens_per_message
+        self.log("ask(): prompt_tokens="+str(prompt_tokens)+", max_tokens="+str(api_openai.get_max_tokens(prompt_tokens,llm_main_model,3000)))
         
         
         message_history.insert(0,{
             "role":"system",
-            "content":system_prompt
+            "content":date_time_prompt+system_prompt
         })
 
         # add new message to message history
@@ -276,25 +562,31 @@ class KittyAIapi:
             "role":"user",
             "content":new_message
             })
+        # the same question is answered from the cache all day, not only within the same minute
+        key_messages = [{"role":"system","content":system_prompt}]+message_history[1:]
 
         self.log("ask(): message_history="+str(message_history))
 
-        # send message to OpenAI API and get response
-        response, used_tokens = await api_openai.get_llm_response(
+        # send message to OpenAI API and get the response as a stream of text deltas
+        response = await self.get_llm_response(
             key = open_ai_key,
             messages = message_history,
             temperature=llm_main_creativity,
-            model = llm_main_model
+            model = llm_main_model,
+            use_cache = context.get_channel_setting("llm_response_cache"),
+            user_id = context.user_id,
+            channel_id = context.channel_id,
+            key_messages = key_messages
         )
 
         return response
 
-    async def get_thread_name(self,user_id,message):
+    async def get_thread_name(self,user_id,message,context=None):
         self.log("get_thread_name(message="+message+")")
-        # get key from user_id
-        open_ai_key = await self.get_api_key(user_id,"OPENAI_API_KEY")
+        # get key from the request context or user_id
+        open_ai_key = context.get_api_key("OPENAI_API_KEY") if context else await self.get_api_key(user_id,"OPENAI_API_KEY")
         #  use gpt-3.5-turbo to generate a thread name
-        thread_name, tokens_used = await api_openai.get_llm_response(
+        thread_name_stream = await self.get_llm_response(
             key = open_ai_key,
             messages = [
                 {
@@ -306,11 +598,18 @@ class KittyAIapi:
                     "content":message
                 }
                 ],
-                model="gpt-3.5-turbo"
+                model="gpt-3.5-turbo",
+                task="thread_name",
+                # the same first message gets the same thread name, if the channel caches answers
+                use_cache=context.get_channel_setting("llm_response_cache") if context else False,
+                user_id=user_id,
+                channel_id=context.channel_id if context else None
         )
+        thread_name = await thread_name_stream.text()
+        tokens_used = thread_name_stream.tokens_used
         self.log("get_thread_name(): thread_name="+thread_name)
         self.log("get_thread_name(): tokens_used="+str(tokens_used))
-        cost = api_openai.get_costs(tokens_used,"gpt-3.5-turbo")
+        cost = api_openai.get_costs(tokens_used,thread_name_stream.model)
         self.log("get_thread_name(): Cost USD: \n"+str(cost))
         # return first 100 characters of thread name
         return thread_name[:97]+"..." if len(thread_name) > 100 else thread_name
@@ -508,18 +807,8 @@ class KittyAIapi:
         # check if all plugins are usable (keys are set)
         # remove every plugin from the list where keys have not been set
         self.log("Checking keys for all plugins: "+str(plugins_list))
-        useable_plugins = []
-        for plugin in plugins_list:
-            self.log("Checking keys for plugin: "+plugin)
-            # check if all keys are set for each plugin using get_api_key. If yes, add it to the list of accessible plugins
-            key_accessible = True
-            for key in self.required_api_keys[plugin]:
-                if not await self.get_api_key(user_id,key):
-                    key_accessible = False
-                    break
-            
-            if key_accessible:
-                useable_plugins.append(plugin)
+        capabilities = await self.get_user_capabilities(user_id)
+        useable_plugins = [plugin for plugin in plugins_list if plugin in capabilities]
         
         return useable_plugins
     
@@ -584,31 +873,45 @@ class KittyAIapi:
     #############################
 
     
-    async def get_system_prompt(self,user_id,channel_id,usable_plugins=[]):
+    async def get_date_time_prompt(self,channel_id,context=None,channel_settings=None):
+        # the date and time at the location of the channel ("" if the channel has no location or the timezone is unknown)
+        channel_id = str(channel_id)
+        if channel_settings is None:
+            channel_settings = context.channel_settings.to_dict() if context else await self.get_channel_settings(channel_id,"all")
+
+        prompt = ""
+        # if channel location is set, get the date and time for that location
+        if "location" in channel_settings and channel_settings["location"]:
+            # if no timezone set for channel, get it based on the location
+            if not "timezone" in channel_settings or not channel_settings["timezone"]:
+                try:
+                    channel_settings["timezone"] = await helpertools.location_to_timezone(channel_settings["location"])
+                    # save the timezone to the channel settings
+                    await self.update_channel_setting(channel_id,"timezone",channel_settings["timezone"])
+                except Exception as e:
+                    # e.g. the geocoder is not reachable, answer without the date and time
+                    self.log("get_date_time_prompt(): could not get the timezone for "+str(channel_settings["location"])+": "+str(e),failure=True)
+
+            if channel_settings.get("timezone"):
+                prompt += await helpertools.get_date_time_location(channel_settings["location"],channel_settings["timezone"])+"\n"
+        return prompt
+
+    async def get_system_prompt(self,user_id,channel_id,usable_plugins=[],context=None,date_time=True):
         user_id = str(user_id)
         channel_id = str(channel_id)
 
         self.log("get_system_prompt(user_id="+user_id+",channel_id="+channel_id+")")
         # get channel settings for the system prompt and plugins
-        channel_settings = await self.get_channel_settings(channel_id,"all")
+        channel_settings = context.channel_settings.to_dict() if context else await self.get_channel_settings(channel_id,"all")
 
         # build system prompt:
         
+        # + date and time (see get_date_time_prompt)
         # + plugin prompt
         # + plugins
         # + system prompt
 
-        prompt = ""
-        # Date + Location
-        # if channel location is set, get the date and time for that location
-        if "location" in channel_settings and channel_settings["location"]:
-            # if no timezone set for channel, get it based on the location
-            if not "timezone" in channel_settings or not channel_settings["timezone"]:
-                channel_settings["timezone"] = await helpertools.location_to_timezone(channel_settings["location"])
-                # save the timezone to the channel settings
-                await self.update_channel_setting(channel_id,"timezone",channel_settings["timezone"])
-
-            prompt += await helpertools.get_date_time_location(channel_settings["location"],channel_settings["timezone"])+"\n"
+        prompt = await self.get_date_time_prompt(channel_id,channel_settings=channel_settings) if date_time else ""
 
         # # add all plugins
         # # if no plugins defined, use default plugins (all)
@@ -656,12 +959,9 @@ class KittyAIapi:
         user_id = str(user_id)
         key_type = str(key_type)
         self.log("get_api_key(user_id="+user_id+",key_type="+key_type+")")
-        # generate the path to the .env file with self.default_user_secrets_folder, independent of the operating system
-        path = os.path.join(self.default_user_secrets_folder, f"{user_id}.env")
-        key = None
-        if os.path.exists(path):
-            load_dotenv(path, override=True)
-            key = os.getenv(key_type)
+        count_storage_lookup()
+        user_secrets = await self.storage.get_user_secrets(user_id)
+        key = user_secrets.get(key_type)
         if key:
             return key
         else:
@@ -675,23 +975,9 @@ class KittyAIapi:
         key = str(key)
         self.log("set_api_key(user_id="+user_id+",key_type="+key_type+",key="+key+")")
 
-        # check if the user has a .env file
-        env_file_path = os.path.join(self.default_user_secrets_folder, f"{user_id}.env")
-        if not os.path.exists(env_file_path):
-            # create the .env file
-            with open(env_file_path, "w") as f:
-                f.write(f"{key_type}=\"{key}\"")
-            
-        else:
-            # load the existing .env file
-            env_values = dotenv_values(env_file_path)
-            env_values[key_type] = key
-
-            # update the .env file with the new key value
-            with open(env_file_path, "w") as f:
-                for k, v in env_values.items():
-                    f.write(f"{k}=\"{v}\"\n")
-            self.log("API key saved")
+        await self.storage.set_user_secret(user_id,key_type,key)
+        self.user_capabilities.pop(user_id,None)
+        self.log("API key saved")
 
         return True
 
@@ -701,23 +987,108 @@ class KittyAIapi:
 
         # delete the api key from the database
         self.log("delete_api_key(user_id="+user_id+",key_type="+key_type+")")
-        # check if the user has a .env file
-        env_file_path = os.path.join("users", f"{user_id}.env")
-        if os.path.exists(env_file_path):
-            # load the existing .env file
-            env_values = dotenv_values(env_file_path)
-            del env_values[key_type]
-
-            # update the .env file with the new key value
-            with open(env_file_path, "w") as f:
-                for k, v in env_values.items():
-                    f.write(f"{k}=\"{v}\"\n")
-            self.log("API key deleted")
+        await self.storage.delete_user_secret(user_id,key_type)
+        self.user_capabilities.pop(user_id,None)
+        self.log("API key deleted")
         
         return True
 
     ####################
 
+    ####################
+    ## Settings inheritance
+    ####################
+
+    def guild_settings_id(self,guild_id):
+        # guild defaults are saved like the settings of a channel, under the id "guild_<guild id>"
+        return "guild_"+str(guild_id)
+
+    def settings_chain(self,channel_id,parent_channel_id=None,guild_id=None):
+        # the ids settings are inherited from, most specific first: thread -> channel -> guild
+        chain = [str(channel_id)]
+        if parent_channel_id:
+            chain.append(str(parent_channel_id))
+        if guild_id:
+            chain.append(self.guild_settings_id(guild_id))
+        return tuple(chain)
+
+    async def resolve_channel_settings(self,channel_id,parent_channel_id=None,guild_id=None,layers=None):
+        # returns (settings, settings channel id): the ChannelSettings after inheritance from the guild and parent channel,
+        # and the channel changes from a thread are saved for (the thread if it has own settings, else the parent channel)
+        # layers (optional) are the already loaded settings records: {id: ChannelSettings or None}
+        chain = self.settings_chain(channel_id,parent_channel_id,guild_id)
+        resolved = self.resolved_channel_settings.get(chain)
+        if resolved:
+            return resolved
+
+        self.log("resolve_channel_settings(chain="+str(chain)+")")
+        if layers is None or any(scope_id not in layers for scope_id in chain):
+            layers = {scope_id: await self.storage.get_channel_settings(scope_id) for scope_id in chain}
+
+        # apply guild, channel and thread settings on top of each other (the defaults are shared by all records)
+        settings = ChannelSettings().merged(*[layers[scope_id] for scope_id in reversed(chain)])
+
+        settings_channel_id = str(channel_id)
+        if parent_channel_id and layers[str(channel_id)] is None:
+            settings_channel_id = str(parent_channel_id)
+
+        resolved = (settings,settings_channel_id)
+        if len(self.resolved_channel_settings) >= self.max_resolved_channel_settings:
+            self.resolved_channel_settings.clear()
+            self.resolved_settings_dependents.clear()
+        self.resolved_channel_settings[chain] = resolved
+        for scope_id in chain:
+            self.resolved_settings_dependents.setdefault(scope_id,set()).add(chain)
+        return resolved
+
+    def invalidate_resolved_settings(self,scope_id):
+        # remove all cached settings which inherit from this channel/guild
+        for chain in self.resolved_settings_dependents.pop(str(scope_id),()):
+            self.resolved_channel_settings.pop(chain,None)
+
+    ####################
+
+    ####################
+    ## Request context
+    ####################
+
+    async def get_request_context(self,user_id,channel_id,parent_channel_id=None,guild_id=None):
+        # load the channel settings, user settings and API keys needed to answer a message in one go (see StorageBackend.load_request_data)
+        self.log("get_request_context(user_id="+str(user_id)+",channel_id="+str(channel_id)+",parent_channel_id="+str(parent_channel_id)+",guild_id="+str(guild_id)+")")
+        context = RequestContext(user_id,channel_id,parent_channel_id,guild_id)
+
+        # the channel settings only need to be loaded if they are not cached yet
+        chain = self.settings_chain(channel_id,parent_channel_id,guild_id)
+        channel_ids = [] if chain in self.resolved_channel_settings else list(chain)
+        # load_request_data makes one backend call per channel settings layer, one for the user settings and one for the secrets
+        context.storage_lookups += len(channel_ids)+2
+        if context.user_id in self.usage_ledger.loaded_users:
+            channel_settings, context.user_settings, context.user_secrets = await self.storage.load_request_data(channel_ids,context.user_id)
+        else:
+            # the saved usage of the month is needed for the budget check (see check_budget), it is loaded once per user,
+            # at the same time as the user data
+            context.storage_lookups += 1
+            (channel_settings, context.user_settings, context.user_secrets), _ = await asyncio.gather(
+                self.storage.load_request_data(channel_ids,context.user_id),
+                self.usage_ledger.load_user(context.user_id)
+            )
+
+        context.channel_settings, context.channel_id = await self.resolve_channel_settings(channel_id,parent_channel_id,guild_id,layers=channel_settings)
+
+        context.capabilities = await self.get_user_capabilities(context.user_id,user_secrets=context.user_secrets)
+
+        # if the channel has set a default llm and user has access to it, use it. Else, use the default llm from the user settings
+        channel_llm = context.get_channel_setting("llm_default_model")
+        user_llm = context.get_user_setting("llm_default_model")
+        if channel_llm in context.capabilities:
+            context.selected_model = channel_llm
+        elif user_llm in context.capabilities:
+            context.selected_model = user_llm
+
+        return context
+
+    ####################
+
     ####################
     ## User permissions
     ####################
@@ -733,11 +1104,27 @@ class KittyAIapi:
             self.log("Error: LLM not found: "+llm,True)
             return False
         
-        needed_keys = self.required_api_keys[llm]
-        for key in needed_keys:
-            if not await self.get_api_key(user_id,key):
-                return False
-        return True
+        return llm in await self.get_user_capabilities(user_id)
+
+    async def get_user_capabilities(self,user_id,user_secrets=None):
+        user_id = str(user_id)
+
+        # return all LLMs and plugins (from self.required_api_keys) for which the user has set all needed API keys
+        if user_secrets is None:
+            count_storage_lookup()
+            user_secrets = await self.storage.get_user_secrets(user_id)
+        cached = self.user_capabilities.get(user_id)
+        # the storage returns the same secrets object as long as the secrets did not change
+        if cached and cached[0] is user_secrets:
+            return cached[1]
+
+        self.log("get_user_capabilities(user_id="+user_id+")")
+        capabilities = frozenset(
+            name for name, needed_keys in self.required_api_keys.items()
+            if all(user_secrets.get(key) for key in needed_keys)
+            )
+        self.user_capabilities[user_id] = (user_secrets,capabilities)
+        return capabilities
 
     ####################
     ## User Settings
@@ -747,26 +1134,20 @@ class KittyAIapi:
         user_id = str(user_id)
         setting = str(setting)
 
-        # check if user_settings/user_id.json exists and load it
+        # load the saved user settings
         self.log("get_user_settings(user_id="+user_id+",setting="+setting+")")
+        count_storage_lookup()
+        user_settings = await self.storage.get_user_settings(user_id)
 
-        # load user settings json
-        if os.path.exists(self.default_user_settings_folder+'/'+user_id+'.json'):
-            with open(self.default_user_settings_folder+'/'+user_id+'.json') as f:
-                user_settings = json.load(f)
-
-                if setting == "all":
-                    return user_settings
+        if user_settings is not None:
+            if setting == "all":
+                return copy.deepcopy(user_settings.to_dict())
+            else:
+                # return the setting (or its default value)
+                if setting in self.default_user_settings:
+                    return copy.deepcopy(user_settings.get(setting))
                 else:
-                    # return the setting
-                    if setting in user_settings:
-                        return user_settings[setting]
-                    else:
-                        # return default value
-                        if setting in self.default_user_settings:
-                            return self.default_user_settings[setting]
-                        else:
-                            self.log("Error: Setting not found in default settings",True)
+                    self.log("Error: Setting not found in default settings",True)
 
 
     async def update_user_setting(self,user_id,setting,new_value):
@@ -775,25 +1156,17 @@ class KittyAIapi:
 
         # update the user setting to the database
         self.log("update_user_setting(user_id="+user_id+",setting="+setting+",value="+str(new_value)+")")
-        # check if user_settings/user_id.json exists and load it
-        if os.path.exists(self.default_user_settings_folder+'/'+user_id+'.json'):
-            with open(self.default_user_settings_folder+'/'+user_id+'.json') as f:
-                user_settings = json.load(f)
-
-                # update setting, if it exists or not
-                user_settings[setting] = new_value
-
-                # save user settings json
-                with open(self.default_user_settings_folder+'/'+user_id+'.json', 'w') as f:
-                    json.dump(user_settings, f, indent=4)
-                    self.log("User setting ("+setting+") for "+user_id+" updated: "+str(new_value))
-        else:
-            # create user_settings/user_id.json based on default_user_settings
-            with open(self.default_user_settings_folder+'/'+user_id+'.json', 'w') as f:
-                user_settings = self.default_user_settings
-                user_settings[setting] = new_value
-                json.dump(user_settings, f, indent=4)
-                self.log("User setting ("+setting+") for "+user_id+" updated: "+str(new_value))
+        # only the custom settings are saved, the defaults are shared
+        await self.storage.update_user_settings(user_id,{setting:new_value})
+        self.log("User setting ("+setting+") for "+user_id+" updated: "+str(new_value))
+
+
+    async def update_user_settings(self,user_id,new_settings):
+        user_id = str(user_id)
+
+        # update several user settings with a single write
+        self.log("update_user_settings(user_id="+user_id+",new_settings="+str(new_settings)+")")
+        await self.storage.update_user_settings(user_id,copy.deepcopy(new_settings))
 
 
     async def update_user_location(self,user_id,new_location):
@@ -803,35 +1176,61 @@ class KittyAIapi:
         # get the timezone from the location
         timezone = await helpertools.location_to_timezone(new_location)
 
-        # update the user location and timezone
-        await self.update_user_setting(user_id,"location",new_location)
-        await self.update_user_setting(user_id,"timezone",timezone)
+        # update the user location and timezone in one write
+        await self.storage.update_user_settings(str(user_id),{"location":new_location,"timezone":timezone})
 
     
     async def reset_user_settings(self,user_id):
         # reset the user settings to the default settings
         self.log("reset_user_settings(user_id="+str(user_id)+")")
-        # check if user_settings/user_id.json exists and load it
-        if os.path.exists(self.default_user_settings_folder+'/'+str(user_id)+'.json'):
-            # delete user_settings/user_id.json
-            os.remove(self.default_user_settings_folder+'/'+str(user_id)+'.json')
+        await self.storage.reset_user_settings(str(user_id))
         self.log("User settings for "+str(user_id)+" reset")
 
     ####################
     ## Setup API Keys
     ####################
 
+    def check_openai_api_key(self,OPENAI_API_KEY):
+        # starts the checks of the key for all OpenAI models at the same time, returns {model: task}.
+        # Only the results of the models that are needed have to be awaited, the others are cached for the next setup
+        checks = {
+            "OpenAI gpt-4": api_openai.api_key_gpt_4_valid,
+            "OpenAI gpt-3.5-turbo": api_openai.api_key_gpt_3_5_turbo_valid
+        }
+        return {
+            llm: asyncio.ensure_future(self.key_validations.validate(llm,(OPENAI_API_KEY,),check,OPENAI_API_KEY))
+            for llm, check in checks.items()
+        }
+
+    def check_google_api_key(self,GOOGLE_API_KEY,GOOGLE_CX_ID=None):
+        # like check_openai_api_key, for all Google plugins. Google Search is only checked with a cx id
+        checks = {
+            "YouTube": ((GOOGLE_API_KEY,),api_google.youtube_api_key_valid),
+            "Google Maps": ((GOOGLE_API_KEY,),api_google.google_maps_api_key_valid)
+        }
+        if GOOGLE_CX_ID:
+            checks["Google Search"] = ((GOOGLE_API_KEY,GOOGLE_CX_ID),api_google.google_search_api_keys_valid)
+        return {
+            plugin: asyncio.ensure_future(self.key_validations.validate(plugin,keys,check,*keys))
+            for plugin, (keys, check) in checks.items()
+        }
+
     async def setup_llm_openai_gpt_4(self,user_id,OPENAI_API_KEY):
         user_id = str(user_id)
         OPENAI_API_KEY = str(OPENAI_API_KEY)
 
         self.log("setup_llm_openai_gpt_4(user_id="+user_id+",OPENAI_API_KEY="+OPENAI_API_KEY+")")
 
-        # check if the API key is valid for GPT4 using the api_key_gpt_4_valid() function
-        if await api_openai.api_key_gpt_4_valid(OPENAI_API_KEY):
+        # check if the API key is valid for GPT4 (the result for GPT3.5 Turbo is checked at the same time and cached)
+        valid = await self.check_openai_api_key(OPENAI_API_KEY)["OpenAI gpt-4"]
+        if valid:
             await self.set_api_key(user_id,"OPENAI_API_KEY",OPENAI_API_KEY)
             await self.update_user_setting(user_id,"llm_default_model","OpenAI gpt-4")
             return True
+        elif valid is None:
+            # the API is busy or its quota is used up, the key may be valid
+            self.log("Error: could not check the API key for GPT4 right now",True)
+            return None
         else:
             self.log("Error: API key is not valid for GPT4",True)
             return False
@@ -844,10 +1243,15 @@ class KittyAIapi:
         self.log("setup_llm_openai_gpt_3_5_turbo(user_id="+user_id+",OPENAI_API_KEY="+OPENAI_API_KEY+")")
 
         # check if the API key is valid for GPT3.5 Turbo
-        if await api_openai.api_key_gpt_3_5_turbo_valid(OPENAI_API_KEY):
+        valid = await self.check_openai_api_key(OPENAI_API_KEY)["OpenAI gpt-3.5-turbo"]
+        if valid:
             await self.set_api_key(user_id,"OPENAI_API_KEY",OPENAI_API_KEY)
             await self.update_user_setting(user_id,"llm_default_model","OpenAI gpt-3.5-turbo")
             return True
+        elif valid is None:
+            # the API is busy or its quota is used up, the key may be valid
+            self.log("Error: could not check the API key for GPT3.5 Turbo right now",True)
+            return None
         else:
             self.log("Error: API key is not valid for GPT3.5 Turbo",True)
             return False
@@ -860,10 +1264,15 @@ class KittyAIapi:
         self.log("setup_plugin_google(user_id="+user_id+",GOOGLE_API_KEY="+GOOGLE_API_KEY+",GOOGLE_CX_ID="+GOOGLE_CX_ID+")")
 
         # check if the API key is valid for Google
-        if await api_google.google_search_api_keys_valid(GOOGLE_API_KEY,GOOGLE_CX_ID):
+        valid = await self.check_google_api_key(GOOGLE_API_KEY,GOOGLE_CX_ID)["Google Search"]
+        if valid:
             await self.set_api_key(user_id,"GOOGLE_API_KEY",GOOGLE_API_KEY)
             await self.set_api_key(user_id,"GOOGLE_CX_ID",GOOGLE_CX_ID)
             return True
+        elif valid is None:
+            # the API is busy or its quota is used up, the key may be valid
+            self.log("Error: could not check the API key for Google Search right now",True)
+            return None
         else:
             self.log("Error: GOOGLE_API_KEY or GOOGLE_CX_ID are not valid for Google Search.",True)
             return False
@@ -876,9 +1285,14 @@ class KittyAIapi:
         self.log("setup_plugin_youtube(user_id="+user_id+",GOOGLE_API_KEY="+GOOGLE_API_KEY+")")
 
         # check if the API key is valid for Google
-        if await api_google.youtube_api_key_valid(GOOGLE_API_KEY):
+        valid = await self.check_google_api_key(GOOGLE_API_KEY)["YouTube"]
+        if valid:
             await self.set_api_key(user_id,"GOOGLE_API_KEY",GOOGLE_API_KEY)
             return True
+        elif valid is None:
+            # the API is busy or its quota is used up, the key may be valid
+            self.log("Error: could not check the API key for YouTube right now",True)
+            return None
         else:
             self.log("Error: GOOGLE_API_KEY is not valid for YouTube.",True)
             return False
@@ -891,9 +1305,14 @@ class KittyAIapi:
         self.log("setup_plugin_google_maps(user_id="+user_id+",GOOGLE_API_KEY="+GOOGLE_API_KEY+")")
 
         # check if the API key is valid for Google
-        if await api_google.google_maps_api_key_valid(GOOGLE_API_KEY):
+        valid = await self.check_google_api_key(GOOGLE_API_KEY)["Google Maps"]
+        if valid:
             await self.set_api_key(user_id,"GOOGLE_API_KEY",GOOGLE_API_KEY)
             return True
+        elif valid is None:
+            # the API is busy or its quota is used up, the key may be valid
+            self.log("Error: could not check the API key for Google Maps right now",True)
+            return None
         else:
             self.log("Error: GOOGLE_API_KEY is not valid for Google Maps.",True)
             return False
@@ -908,55 +1327,25 @@ class KittyAIapi:
 
         # return if the channel settings exist or not
         self.log("channel_settings_exist(channel_id="+channel_id+")")
-        if not os.path.exists('channel_settings.json'):
-            return False
-        
-        with open('channel_settings.json') as f:
-            channel_settings = json.load(f)
-
-            if channel_id in channel_settings["channels"]:
-                return True
-            else:
-                return False
+        count_storage_lookup()
+        return await self.storage.channel_settings_exist(channel_id)
             
     
-    async def get_channel_settings(self,channel_id,setting="all"):
+    async def get_channel_settings(self,channel_id,setting="all",parent_channel_id=None,guild_id=None):
         # get the channel settings from the database
+        # for threads, the parent_channel_id and guild_id can be given, to inherit their settings (thread -> channel -> guild -> defaults)
         self.log("get_channel_settings(channel_id="+str(channel_id)+",setting="+str(setting)+")")
-        # load channel settings json
-        if not os.path.exists('channel_settings.json'):
-            default_channel_settings = {"channels":{}}
-            with open('channel_settings.json', 'w') as f:
-                json.dump(default_channel_settings, f, indent=4)
-
-        with open('channel_settings.json') as f:
-            channel_settings = json.load(f)
-            self.log("channel_settings.json:")
-            self.log(str(channel_settings))
-
-            if str(channel_id) in channel_settings["channels"]:
-                if setting == "all":
-                    return channel_settings["channels"][str(channel_id)]
-                else:
-                    # return the setting
-                    if setting in channel_settings["channels"][str(channel_id)]:
-                        return channel_settings["channels"][str(channel_id)][setting]
-                    else:
-                        # return default value
-                        if setting in self.default_channel_settings:
-                            return self.default_channel_settings[setting]
-                        else:
-                            self.log("Error: Setting not found in default settings",True)
+        count_storage_lookup()
+        channel_settings, settings_channel_id = await self.resolve_channel_settings(channel_id,parent_channel_id,guild_id)
+
+        if setting == "all":
+            return copy.deepcopy(channel_settings.to_dict())
+        else:
+            # return the setting (or its default value)
+            if setting in self.default_channel_settings:
+                return copy.deepcopy(channel_settings.get(setting))
             else:
-                # if no custom settings, return default settings
-                if setting == "all":
-                    return self.default_channel_settings
-                else:
-                    # return default value
-                    if setting in self.default_channel_settings:
-                        return self.default_channel_settings[setting]
-                    else:
-                        self.log("Error: Setting not found in default settings",True)
+                self.log("Error: Setting not found in default settings",True)
 
     
     async def update_channel_setting(self,channel_id,setting,new_value):
@@ -964,30 +1353,16 @@ class KittyAIapi:
         # settings: llm_systemprompt, llm_creativity, autorespond, num_of_last_messages_included, debug_mode
         self.log("update_channel_setting(channel_id="+str(channel_id)+",setting="+str(setting)+",new_value="+str(new_value)+")")
 
-        if os.path.exists('channel_settings.json'):
-            with open('channel_settings.json') as f:
-                channel_settings = json.load(f)
-                self.log("old channel_settings.json:")
-                self.log(str(channel_settings))
+        await self.storage.update_channel_setting(channel_id,setting,copy.deepcopy(new_value))
+        self.invalidate_resolved_settings(channel_id)
 
-                # update the channel settings
-                if str(channel_id) in channel_settings["channels"]:
-                    channel_settings["channels"][str(channel_id)][setting] = new_value
-                else:
-                    channel_settings["channels"][str(channel_id)] = {}
-                    channel_settings["channels"][str(channel_id)][setting] = new_value
-        else:
-            # create the channel_settings.json file and add the channel settings
-            channel_settings = {}
-            channel_settings["channels"] = {}
-            channel_settings["channels"][str(channel_id)] = {}
-            channel_settings["channels"][str(channel_id)][setting] = new_value
 
-        # save the channel settings
-        with open('channel_settings.json', 'w') as f:
-            json.dump(channel_settings, f, indent=4)
-            self.log("saved new channel_settings.json:")
-            self.log(str(channel_settings))
+    async def update_channel_settings(self,channel_id,new_settings):
+        # update several channel settings with a single write
+        self.log("update_channel_settings(channel_id="+str(channel_id)+",new_settings="+str(new_settings)+")")
+
+        await self.storage.update_channel_settings(str(channel_id),copy.deepcopy(new_settings))
+        self.invalidate_resolved_settings(channel_id)
 
 
     async def update_channel_location(self,channel_id,new_location):
@@ -997,9 +1372,9 @@ class KittyAIapi:
         # get the timezone from the location
         timezone = await helpertools.location_to_timezone(new_location)
 
-        # update the channel location and timezone
-        await self.update_channel_setting(channel_id,"location",new_location)
-        await self.update_channel_setting(channel_id,"timezone",timezone)
+        # update the channel location and timezone in one write
+        await self.storage.update_channel_settings(str(channel_id),{"location":new_location,"timezone":timezone})
+        self.invalidate_resolved_settings(channel_id)
 
 
     async def reset_channel_setting(self,channel_id,setting):
@@ -1008,27 +1383,11 @@ class KittyAIapi:
         # reset the channel setting to default
         self.log("reset_channel_setting(channel_id="+str(channel_id)+",setting="+str(setting)+")")
 
-        if os.path.exists('channel_settings.json'):
-            with open('channel_settings.json') as f:
-                channel_settings = json.load(f)
-                self.log("old channel_settings.json:")
-                self.log(str(channel_settings))
-
-                # reset the channel setting
-                if channel_id in channel_settings["channels"]:
-                    if setting in channel_settings["channels"][channel_id]:
-                        del channel_settings["channels"][channel_id][setting]
-                        # save the channel settings
-                        with open('channel_settings.json', 'w') as f:
-                            json.dump(channel_settings, f, indent=4)
-                            self.log("saved new channel_settings.json:")
-                            self.log(str(channel_settings))
-                    else:
-                        self.log("Error: Setting not found in channel settings",True)
-                else:
-                    self.log("Error: Channel not found in channel settings",True)
-        else:
-            self.log("Error: channel_settings.json not found",True)
+        if not await self.storage.channel_settings_exist(channel_id):
+            self.log("Error: Channel not found in channel settings",True)
+        elif not await self.storage.reset_channel_setting(channel_id,setting):
+            self.log("Error: Setting not found in channel settings",True)
+        self.invalidate_resolved_settings(channel_id)
                         
 
     
@@ -1038,26 +1397,22 @@ class KittyAIapi:
         # reset the channel settings to default
         self.log("reset_channel_settings(channel_id="+channel_id+")")
         
-        if os.path.exists('channel_settings.json'):
-            with open('channel_settings.json') as f:
-                channel_settings = json.load(f)
-                self.log("old channel_settings.json:")
-                self.log(str(channel_settings))
-
-                # reset the channel settings
-                if channel_id in channel_settings["channels"]:
-                    # remove the channel settings
-                    del channel_settings["channels"][channel_id]
-                    # save the channel settings
-                    with open('channel_settings.json', 'w') as f:
-                        json.dump(channel_settings, f, indent=4)
-                        self.log("saved new channel_settings.json:")
-                        self.log(str(channel_settings))
-                        
-                else:
-                    self.log("Channel settings not found",True)
-        else:
-            self.log("Channel settings file not found",True)
+        if not await self.storage.reset_channel_settings(channel_id):
+            self.log("Channel settings not found",True)
+        self.invalidate_resolved_settings(channel_id)
+
+
+    async def update_guild_settings(self,guild_id,new_settings):
+        # set default settings for all channels of a guild (channels and threads can still override them), with a single write
+        self.log("update_guild_settings(guild_id="+str(guild_id)+",new_settings="+str(new_settings)+")")
+        scope_id = self.guild_settings_id(guild_id)
+        await self.storage.update_channel_settings(scope_id,copy.deepcopy(new_settings))
+        self.invalidate_resolved_settings(scope_id)
+
+
+    async def reset_guild_settings(self,guild_id):
+        self.log("reset_guild_settings(guild_id="+str(guild_id)+")")
+        await self.reset_channel_settings(self.guild_settings_id(guild_id))
 
     ####################
 
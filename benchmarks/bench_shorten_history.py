@@ -0,0 +1,80 @@
+import argparse
+import random
+import re
+import time
+import core.api_openai as api_openai
+from api_kittyai import compact_message_history
+
+# micro-benchmark for compacting the message history before it is summarized (compact_message_history),
+# compared to the previous implementation, which counted the tokens of the whole transcript again for every message.
+# The cost per message should stay flat when the history gets longer (num_of_last_messages_included / the limit of get_thread_history).
+# run from the repository root: python -m benchmarks.bench_shorten_history
+
+words = "the cat sat on a mat and asked kitty about weather news code python discord thread summary token model".split()
+
+
+def make_history(num_messages,words_per_message=40,seed=0):
+    rng = random.Random(seed)
+    history = []
+    for i in range(num_messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = " ".join(rng.choice(words) for _ in range(words_per_message))
+        if role == "assistant":
+            content += " https://www.example.com/page/"+str(i)
+        # a number makes every message unique, so the token count cache doesn't hide the work
+        history.append({"role": role, "content": str(i)+" "+content})
+    return history
+
+
+def compact_message_history_quadratic(previous_chat_history,max_tokens,model="gpt-3.5-turbo"):
+    # the previous implementation of shorten_message_history, without the logging
+    summarize_this_chat_history = ""
+    most_recent_response = None
+    for i,entry in enumerate(previous_chat_history):
+        entry = dict(entry)
+        if entry["role"] == "assistant":
+            entry["content"] = re.sub(r'(https?://)?(www\.)?(?P<domain>[a-zA-Z0-9-]+)\.(?P<extension>[a-zA-Z0-9-]+)(\.[a-zA-Z0-9-]+)?(/.*)?', r'\g<domain>.\g<extension>/...', entry["content"])
+        if i < len(previous_chat_history)-1:
+            encoding = api_openai.get_encoding(model)
+            token_length = len(encoding.encode_ordinary(entry["content"]))
+            if len(encoding.encode_ordinary(summarize_this_chat_history))+token_length <= max_tokens:
+                summarize_this_chat_history += entry["role"]+": "+entry["content"]+"\n"
+        else:
+            most_recent_response = entry
+    return summarize_this_chat_history, most_recent_response
+
+
+def measure(func,history,max_tokens,repeat):
+    best = None
+    for _ in range(repeat):
+        # start without cached token counts, like for a new thread
+        api_openai.token_counts.clear()
+        started = time.perf_counter()
+        func(history,max_tokens)
+        elapsed = time.perf_counter()-started
+        best = elapsed if best is None else min(best,elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compacting the message history.")
+    parser.add_argument("--sizes",default="5,15,50,100,200,400",help="Comma separated numbers of messages in the history.")
+    parser.add_argument("--max-tokens",type=int,default=2000,help="llm_summarize_max_tokens")
+    parser.add_argument("--repeat",type=int,default=5)
+    args = parser.parse_args()
+
+    api_openai.warm_up_encodings()
+    print(f"{'messages':>8} {'quadratic ms':>13} {'per msg us':>11} {'linear ms':>10} {'per msg us':>11} {'warm cache ms':>14}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        history = make_history(size)
+        quadratic = measure(compact_message_history_quadratic,history,args.max_tokens,args.repeat)
+        linear = measure(compact_message_history,history,args.max_tokens,args.repeat)
+        # the next turn reads the same messages again, their token counts are cached
+        started = time.perf_counter()
+        compact_message_history(history,args.max_tokens)
+        warm = time.perf_counter()-started
+        print(f"{size:>8} {quadratic*1000:>13.2f} {quadratic/size*1e6:>11.1f} {linear*1000:>10.2f} {linear/size*1e6:>11.1f} {warm*1000:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ from discord import Thread
 from dotenv import load_dotenv
 load_dotenv()
 import asyncio
+import helpertools
 
 ai = KittyAIapi(debug=False)
 
@@ -19,7 +20,13 @@ intents.messages = True
 intents.presences = False
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class KittyBot(commands.Bot):
+    async def close(self):
+        # called when the bot stops (also on Ctrl+C), while the event loop is still running
+        await super().close()
+        await ai.close()
+
+bot = KittyBot(command_prefix="!", intents=intents)
 
 ongoing_tasks = {}
 
@@ -28,41 +35,87 @@ ongoing_tasks = {}
 ########################]
 
 
-# check if autorespond is enabled for the channel or the channel in which the thread is inside
+# the ids a channel inherits its settings from: thread -> channel -> guild
+def get_settings_chain(channel):
+    parent_channel_id = None
+    if channel.type == discord.ChannelType.public_thread or channel.type == discord.ChannelType.private_thread:
+        parent_channel_id = channel.parent_id
+    guild_id = channel.guild.id if getattr(channel, "guild", None) else None
+    return channel.id, parent_channel_id, guild_id
+
+
+# load the settings, API keys and model for a message once, they are then passed on to all other functions
+async def get_request_context(message):
+    channel_id, parent_channel_id, guild_id = get_settings_chain(message.channel)
+    return await ai.get_request_context(
+        user_id=message.author.id,
+        channel_id=channel_id,
+        parent_channel_id=parent_channel_id,
+        guild_id=guild_id
+    )
+
+
+# get a channel setting, including the settings inherited from the parent channel and guild
+async def get_inherited_channel_setting(channel, setting="all"):
+    channel_id, parent_channel_id, guild_id = get_settings_chain(channel)
+    return await ai.get_channel_settings(
+        channel_id=channel_id,
+        setting=setting,
+        parent_channel_id=parent_channel_id,
+        guild_id=guild_id
+    )
+
+
+# check if autorespond is enabled for the channel or the channel in which the thread is inside.
+# Only the channel settings are needed (they are cached), not the user data
 async def is_autorespond_enabled(message):
-    channel_id = message.channel.id
-    # if message is inside a thread, get the parent channel id
-    if message.channel.type == discord.ChannelType.public_thread or message.channel.type == discord.ChannelType.private_thread:
-        channel_id = message.channel.parent_id
-    autorespond = await ai.get_channel_settings(channel_id, "autorespond")
-    return autorespond
+    return await get_inherited_channel_setting(message.channel,"autorespond")
 
 
 # split up functions, to have separate functions for creating a new thread, processing the thread message history
-async def get_thread_history(message):
+# the message ids are used to find the messages that are newer than the saved summary of the thread (see shorten_message_history)
+# limit is only the number of messages loaded from Discord, how many of them are sent to the LLM depends on
+# the context window of the model (see ask and shorten_message_history)
+async def get_thread_history(message, limit=50):
     message_history = []
-    async for msg in message.channel.history(oldest_first=False, limit=15):
+    async for msg in message.channel.history(oldest_first=False, limit=limit):
         if msg.type == discord.MessageType.thread_starter_message:
             thread_starter_message = msg.reference.resolved
             content = thread_starter_message.content.replace(f'<@{bot.user.id}>', '').strip()
-            message_history.insert(0, {"role": "assistant" if thread_starter_message.author.bot else "user", "content": content})
+            message_history.insert(0, {"role": "assistant" if thread_starter_message.author.bot else "user", "content": content, "message_id": thread_starter_message.id})
         else:
             content = msg.content.replace(f'<@{bot.user.id}>', '').strip()
-            message_history.insert(0,{"role": "assistant" if msg.author.bot else "user", "content": content})
+            message_history.insert(0,{"role": "assistant" if msg.author.bot else "user", "content": content, "message_id": msg.id})
     # return all messages except the last one, which is the message that triggered the bot
     return message_history[:-1]
 
 
-async def create_new_thread(message, new_message):
-    thread_name = await ai.get_thread_name(
-        user_id=message.author.id,
-        message=new_message
-    )
+# the thread is created right away with a provisional name (the beginning of the message),
+# the name generated by the LLM is set when it is ready (see rename_thread)
+def get_provisional_thread_name(new_message):
+    thread_name = " ".join(new_message.replace(f'<@{bot.user.id}>', '').split())
+    if not thread_name:
+        return "KittyAI"
+    return thread_name[:97]+"..." if len(thread_name) > 100 else thread_name
+
+
+async def create_new_thread(message, new_message, context=None):
+    thread_name = get_provisional_thread_name(new_message)
     print(f"Creating new thread with name {thread_name}")
     thread = await message.create_thread(name=thread_name)
     return thread
 
 
+async def rename_thread(thread, thread_name_task):
+    try:
+        thread_name = await thread_name_task
+        if thread_name and thread_name != thread.name:
+            print(f"Renaming thread to {thread_name}")
+            await thread.edit(name=thread_name)
+    except Exception as e:
+        print(f"Could not rename thread: {e}")
+
+
 async def send_response(message, response, thread=None):
     assistant_response = ""
     last_sent_assistant_response = ""
@@ -71,9 +124,9 @@ async def send_response(message, response, thread=None):
     message_response = None
     send_new_message = False
 
-    for item in response:
-        if "content" in item['choices'][0]['delta']:
-            partial_response = item['choices'][0]['delta']['content']
+    # response is an LLMStream, waiting for the next text delta doesn't block other channels
+    async for partial_response in response:
+        if partial_response:
             # if message is too long, send it as a new message
             assistant_response += partial_response
 
@@ -112,7 +165,7 @@ async def send_response(message, response, thread=None):
     return message_response
 
 
-async def ask(message,llm):
+async def ask(message,context):
     await message.add_reaction("💭")
 
     #TODO process plugins
@@ -122,25 +175,37 @@ async def ask(message,llm):
     create_new_thread_flag = True if message.channel.type == discord.ChannelType.text else False
     message_history = await get_thread_history(message) if not message.channel.type == discord.ChannelType.text else []
 
-    if create_new_thread_flag:
-        thread = await create_new_thread(message, new_message)
-
-    # if message is inside a thread and the thread is not saved under the channel settings, load settings from parent channel
-    channel_id = str(message.channel.id)
-    if message.channel.type == discord.ChannelType.public_thread or message.channel.type == discord.ChannelType.private_thread:
-        if not await ai.channel_settings_exist(message.channel.id):
-            channel_id = str(message.channel.parent_id)
-        
-
-    response = await ai.ask(
-        channel_id=channel_id,
+    # the request context already knows if a thread uses its own settings or the ones of the parent channel
+    ask_ai = ai.ask(
+        channel_id=context.channel_id,
         user_id=str(message.author.id),
         new_message=new_message,
         previous_chat_history=message_history,
-        llm_main_model=llm
+        llm_main_model=context.selected_model,
+        context=context
     )
 
+    rename_task = None
+    if create_new_thread_flag:
+        # generating the thread name, creating the thread and preparing the answer don't depend on each other
+        thread_name_task = asyncio.create_task(ai.get_thread_name(
+            user_id=message.author.id,
+            message=new_message,
+            context=context
+        ))
+        try:
+            thread, response = await asyncio.gather(create_new_thread(message, new_message, context), ask_ai)
+            rename_task = asyncio.create_task(rename_thread(thread, thread_name_task))
+        finally:
+            # without a thread (e.g. creating it or preparing the answer failed) the name is not needed anymore
+            if rename_task is None:
+                thread_name_task.cancel()
+    else:
+        response = await ask_ai
+
     message_response = await send_response(message, response, thread)
+    if rename_task:
+        await rename_task
     await message.remove_reaction("💭", bot.user)
     await message.add_reaction("✅")
     await bot.process_commands(message)
@@ -164,6 +229,8 @@ async def setup_llm_openai_gpt_4(interaction: discord.Interaction,openai_api_key
     text = "Sorry, something went wrong."
     if success:
         text = f'✅ Successfully set up OpenAI GPT-4 with your API key **"...{openai_api_key[-5:]}"** as your default LLM.'
+    elif success is None:
+        text = f'⏳ Could not check your API key **"...{openai_api_key[-5:]}"** right now, the OpenAI API is busy or its quota is used up. Please try again later.'
     else:
         text = f'❌ Could not set up OpenAI GPT-4 with your API key **"...{openai_api_key[-5:]}"** as your default LLM. Please make sure the API key is correct and has access to the Open AI GPT-4 API.'
     if interaction.channel.type == discord.ChannelType.private:
@@ -180,6 +247,8 @@ async def setup_llm_openai_gpt_3_5_turbo(interaction: discord.Interaction,openai
     text = "Sorry, something went wrong."
     if success:
         text = f'✅ Successfully set up OpenAI GPT-3.5 Turbo with your API key **"...{openai_api_key[-5:]}"** as your default LLM.'
+    elif success is None:
+        text = f'⏳ Could not check your API key **"...{openai_api_key[-5:]}"** right now, the OpenAI API is busy or its quota is used up. Please try again later.'
     else:
         text = f'❌ Could not set up OpenAI GPT-3.5 Turbo with your API key **"...{openai_api_key[-5:]}"** as your default LLM. Please make sure the API key is correct and has access to the Open AI GPT-3.5 Turbo API.'
     if interaction.channel.type == discord.ChannelType.private:
@@ -201,6 +270,8 @@ async def setup_plugin_google(interaction: discord.Interaction,google_api_key:st
     text = "Sorry, something went wrong."
     if success:
         text = f'✅ Successfully set up the Google plugin with your API key **"...{google_api_key[-5:]}"** and your CX ID **"...{google_cx_id[-5:]}"**'
+    elif success is None:
+        text = f'⏳ Could not check your API key **"...{google_api_key[-5:]}"** right now, the Google API is busy or its quota is used up. Please try again later.'
     else:
         text = f'❌ Could not set up the Google plugin with your API key **"...{google_api_key[-5:]}"** and your CX ID **"...{google_cx_id[-5:]}"**. Please make sure the API keys are correct and have access to the Google Search API.'
     if interaction.channel.type == discord.ChannelType.private:
@@ -217,6 +288,8 @@ async def setup_plugin_google_images(interaction: discord.Interaction,google_api
     text = "Sorry, something went wrong."
     if success:
         text = f'✅ Successfully set up the Google Images plugin with your API key **"...{google_api_key[-5:]}"** and your CX ID **"...{google_cx_id[-5:]}"**'
+    elif success is None:
+        text = f'⏳ Could not check your API key **"...{google_api_key[-5:]}"** right now, the Google API is busy or its quota is used up. Please try again later.'
     else:
         text = f'❌ Could not set up the Google Images plugin with your API key **"...{google_api_key[-5:]}"** and your CX ID **"...{google_cx_id[-5:]}"**. Please make sure the API keys are correct and have access to the Google Search API.'
     if interaction.channel.type == discord.ChannelType.private:
@@ -233,6 +306,8 @@ async def setup_plugin_youtube(interaction: discord.Interaction,google_api_key:s
     text = "Sorry, something went wrong."
     if success:
         text = f'✅ Successfully set up the YouTube plugin with your API key **"...{google_api_key[-5:]}"**'
+    elif success is None:
+        text = f'⏳ Could not check your API key **"...{google_api_key[-5:]}"** right now, the Google API is busy or its quota is used up. Please try again later.'
     else:
         text = f'❌ Could not set up the YouTube plugin with your API key **"...{google_api_key[-5:]}"**. Please make sure the API key is correct and has access to the YouTube Data API.'
     if interaction.channel.type == discord.ChannelType.private:
@@ -249,6 +324,8 @@ async def setup_plugin_google_maps(interaction: discord.Interaction,google_api_k
     text = "Sorry, something went wrong."
     if success:
         text = f'✅ Successfully set up the Google Maps plugin with your API key **"...{google_api_key[-5:]}"**'
+    elif success is None:
+        text = f'⏳ Could not check your API key **"...{google_api_key[-5:]}"** right now, the Google API is busy or its quota is used up. Please try again later.'
     else:
         text = f'❌ Could not set up the Google Maps plugin with your API key **"...{google_api_key[-5:]}"**. Please make sure the API key is correct and has access to the Google Maps API.'
     if interaction.channel.type == discord.ChannelType.private:
@@ -282,27 +359,76 @@ async def reset_my_settings(interaction: discord.Interaction):
 
 @bot.tree.command(name="get_channel_settings", description="Gets all settings for this channel.")
 async def get_channel_settings(interaction: discord.Interaction):
-    channel_id = str(interaction.channel.id)
     channel_name = interaction.channel.name
     if interaction.channel.type == discord.ChannelType.text and not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message(f'You need to be an administrator to view the settings for this channel.',ephemeral=True)
         return
 
-    if interaction.channel.type == discord.ChannelType.public_thread or interaction.channel.type == discord.ChannelType.private_thread:
-        if not await ai.channel_settings_exist(interaction.channel.id):
-            channel_id = str(interaction.channel.parent_id)
-            channel_name = interaction.channel.parent.name
-
-    channel_settings = await ai.get_channel_settings(channel_id=channel_id)
+    # settings are inherited: thread -> channel -> guild -> defaults
+    channel_settings = await get_inherited_channel_setting(interaction.channel)
     await interaction.response.send_message(f'**#{channel_name}** settings: {channel_settings}',ephemeral=True)
 
 
+@bot.tree.command(name="set_guild_defaults", description="Sets default settings for all channels on this server. Channels and threads can still change them.")
+async def set_guild_defaults(
+        interaction: discord.Interaction,
+        system_prompt: str = None,
+        creativity: float = None,
+        default_model: str = None,
+        autorespond: bool = None,
+        location: str = None
+        ):
+    if not interaction.guild:
+        await interaction.response.send_message(f'Server defaults can only be set on a server.',ephemeral=True)
+        return
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message(f'You need to be an administrator to set the defaults for **{interaction.guild.name}**.',ephemeral=True)
+        return
+    if default_model and default_model not in ai.supported_llm_models:
+        await interaction.response.send_message(f'Unknown model **{default_model}**. Supported models: {", ".join(ai.supported_llm_models)}',ephemeral=True)
+        return
+
+    new_settings = {}
+    if system_prompt is not None:
+        new_settings["llm_systemprompt"] = system_prompt
+    if creativity is not None:
+        new_settings["llm_creativity"] = creativity
+    if default_model is not None:
+        new_settings["llm_default_model"] = default_model
+    if autorespond is not None:
+        new_settings["autorespond"] = autorespond
+    if location is not None:
+        new_settings["location"] = location
+        new_settings["timezone"] = await helpertools.location_to_timezone(location)
+    if not new_settings:
+        await interaction.response.send_message(f'Please select at least one setting.',ephemeral=True)
+        return
+
+    # all settings are saved with a single write
+    await ai.update_guild_settings(guild_id=interaction.guild.id,new_settings=new_settings)
+    await interaction.response.send_message(f'Updated the defaults for all channels on **{interaction.guild.name}**: {new_settings}',ephemeral=True)
+
+
+@bot.tree.command(name="reset_guild_defaults", description="Resets the default settings for all channels on this server.")
+async def reset_guild_defaults(interaction: discord.Interaction):
+    if not interaction.guild:
+        await interaction.response.send_message(f'Server defaults can only be reset on a server.',ephemeral=True)
+        return
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message(f'You need to be an administrator to reset the defaults for **{interaction.guild.name}**.',ephemeral=True)
+        return
+    await ai.reset_guild_settings(guild_id=interaction.guild.id)
+    await interaction.response.send_message(f'Reset the defaults for all channels on **{interaction.guild.name}**.',ephemeral=True)
+
+
 @bot.tree.command(name="get_my_settings", description="Gets all settings for this user.")
 async def get_my_settings(interaction: discord.Interaction):
     user_id = interaction.user.id
     user_settings = await ai.get_user_settings(user_id=user_id)
+    capabilities = await ai.get_user_capabilities(user_id=user_id)
+    usable = ", ".join(name for name in ai.required_api_keys if name in capabilities) or "nothing yet, use `/setup_...`"
     # make response only visible to the user who sent the command
-    await interaction.response.send_message(f'Your user settings:\n\n{str(user_settings)}', ephemeral=True)
+    await interaction.response.send_message(f'Your user settings:\n\n{str(user_settings)}\n\nYou can use: {usable}', ephemeral=True)
 
 
 @bot.tree.command(name="set_channel_autorespond_off", description="Turns off autorespond feature for this channel. use @KittyAI to get a response.")
@@ -343,13 +469,98 @@ async def get_channel_autorespond(interaction: discord.Interaction):
     if interaction.channel.type == discord.ChannelType.private:
         await interaction.response.send_message(f'Auto respond doesn\'t work for DMs.',ephemeral=True)
         return
-    autorespond = await ai.get_channel_settings(channel_id=channel_id,setting= "autorespond")
+    autorespond = await get_inherited_channel_setting(interaction.channel,setting= "autorespond")
     if autorespond == True:
         await interaction.response.send_message(f'💬 Auto respond for **#{channel_name}** is turned **on**. KittyAI will respond to every message you send.',ephemeral=True)
     else:
         await interaction.response.send_message(f'💬 Auto respond for **#{channel_name}** is turned **off**. You can still mention **@KittyAI** in the channel, to get a response.',ephemeral=True)
 
 
+@bot.tree.command(name="set_channel_response_cache_on", description="Caches the answers when creativity is 0. The same questions get the same answer faster.")
+async def set_channel_response_cache_on(interaction: discord.Interaction):
+    channel_id = interaction.channel.id
+    channel_name = interaction.channel.name if interaction.channel.type != discord.ChannelType.private else "this DM"
+    if interaction.channel.type == discord.ChannelType.text and not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message(f'You need to be an administrator to turn on the response cache for this channel.',ephemeral=True)
+        return
+    await ai.update_channel_setting(channel_id=channel_id,setting= "llm_response_cache",new_value=True)
+    await interaction.response.send_message(f'Turned on the response cache for **{channel_name}**. If the creativity is 0, the same questions get the same answer from the cache.')
+
+
+@bot.tree.command(name="set_channel_response_cache_off", description="Turns off the response cache for this channel.")
+async def set_channel_response_cache_off(interaction: discord.Interaction):
+    channel_id = interaction.channel.id
+    channel_name = interaction.channel.name if interaction.channel.type != discord.ChannelType.private else "this DM"
+    if interaction.channel.type == discord.ChannelType.text and not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message(f'You need to be an administrator to turn off the response cache for this channel.',ephemeral=True)
+        return
+    await ai.update_channel_setting(channel_id=channel_id,setting= "llm_response_cache",new_value=False)
+    await interaction.response.send_message(f'Turned off the response cache for **{channel_name}**.')
+
+
+@bot.tree.command(name="get_channel_response_cache", description="Gets the response cache setting for this channel and how often the cache was used.")
+async def get_channel_response_cache(interaction: discord.Interaction):
+    channel_name = interaction.channel.name if interaction.channel.type != discord.ChannelType.private else "this DM"
+    response_cache = await get_inherited_channel_setting(interaction.channel,setting= "llm_response_cache")
+    stats = ai.get_response_cache_stats()
+    status = "on" if response_cache else "off"
+    await interaction.response.send_message(f'🗄️ The response cache for **{channel_name}** is turned **{status}**.\n\nCache hit rate: {stats["hit_rate"]:.0%} ({stats["hits"]+stats["disk_hits"]} hits, {stats["misses"]} misses, {stats["entries"]} cached answers)',ephemeral=True)
+
+
+@bot.tree.command(name="set_channel_monthly_budget", description="Limits the tokens or costs (EUR) per month in this channel. 0 removes the limit.")
+async def set_channel_monthly_budget(interaction: discord.Interaction, tokens: int = 0, cost_eur: float = 0.0, when_used_up: str = "downgrade"):
+    channel_id = interaction.channel.id
+    channel_name = interaction.channel.name if interaction.channel.type != discord.ChannelType.private else "this DM"
+    if interaction.channel.type == discord.ChannelType.text and not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message(f'You need to be an administrator to set the monthly budget for this channel.',ephemeral=True)
+        return
+    # when the budget is used up: "downgrade" to a cheaper model or "refuse" to answer
+    if when_used_up not in ("downgrade","refuse"):
+        await interaction.response.send_message(f'when_used_up can be "downgrade" (use a cheaper model) or "refuse" (don\'t answer).',ephemeral=True)
+        return
+    await ai.update_channel_settings(channel_id=channel_id,new_settings={
+        "monthly_token_budget": tokens or None,
+        "monthly_cost_budget_eur": cost_eur or None,
+        "budget_exceeded_action": when_used_up
+    })
+    await interaction.response.send_message(f'💰 Monthly budget for **{channel_name}**: {tokens or "no"} token limit, {str(cost_eur)+" EUR" if cost_eur else "no"} cost limit.')
+
+
+@bot.tree.command(name="set_my_monthly_budget", description="Limits your tokens or costs (EUR) per month. 0 removes the limit.")
+async def set_my_monthly_budget(interaction: discord.Interaction, tokens: int = 0, cost_eur: float = 0.0, when_used_up: str = "refuse"):
+    user_id = interaction.user.id
+    # when the budget is used up: "refuse" to answer or "downgrade" to a cheaper model
+    if when_used_up not in ("downgrade","refuse"):
+        await interaction.response.send_message(f'when_used_up can be "downgrade" (use a cheaper model) or "refuse" (don\'t answer).',ephemeral=True)
+        return
+    await ai.update_user_settings(user_id=user_id,new_settings={
+        "monthly_token_budget": tokens or None,
+        "monthly_cost_budget_eur": cost_eur or None,
+        "budget_exceeded_action": when_used_up
+    })
+    await interaction.response.send_message(f'💰 Your monthly budget: {tokens or "no"} token limit, {str(cost_eur)+" EUR" if cost_eur else "no"} cost limit, when used up: {when_used_up}.',ephemeral=True)
+
+
+@bot.tree.command(name="get_my_usage", description="Gets the tokens and estimated costs you used this month.")
+async def get_my_usage(interaction: discord.Interaction):
+    usage = await ai.get_month_usage(user_id=interaction.user.id)
+    await interaction.response.send_message(f'💰 This month you used {usage["tokens"]} tokens (about {usage["cost_eur"]:.2f} EUR).',ephemeral=True)
+
+
+@bot.tree.command(name="get_my_model_stats", description="Gets the latency and error rate of the models used with your OpenAI API key.")
+async def get_my_model_stats(interaction: discord.Interaction):
+    report = await ai.get_model_report(user_id=interaction.user.id)
+    if not report:
+        await interaction.response.send_message(f'📊 No requests have been sent with your OpenAI API key since the bot started.',ephemeral=True)
+        return
+    lines = []
+    for name, stats in report.items():
+        model = name.split("/",1)[1]
+        latency = f'p50 {stats["p50"]:.1f}s, p95 {stats["p95"]:.1f}s' if stats["p50"] is not None else "no latency yet"
+        lines.append(f'**{model}**: {latency}, {stats["error_rate"]:.0%} errors ({stats["requests"]} requests)')
+    await interaction.response.send_message('📊 Models used with your OpenAI API key (last 5 minutes):\n\n'+"\n".join(lines),ephemeral=True)
+
+
 @bot.tree.command(name="set_channel_location", description="Sets the location for this channel. KittyAI will use this location to answer questions.")
 async def set_channel_location(interaction: discord.Interaction, location: str):
     channel_id = interaction.channel.id
@@ -373,7 +584,7 @@ async def set_channel_location(interaction: discord.Interaction, location: str):
 async def get_channel_location(interaction: discord.Interaction):
     channel_id = interaction.channel.id
     channel_name = interaction.channel.name
-    location = await ai.get_channel_settings(channel_id=channel_id,setting= "location")
+    location = await get_inherited_channel_setting(interaction.channel,setting= "location")
     if not location:
         await interaction.response.send_message(f'📍 Location for **#{channel_name}** has not been set.',ephemeral=True)
     else:
@@ -413,7 +624,7 @@ async def set_system_prompt(interaction: discord.Interaction, prompt: str):
 async def get_system_prompt(interaction: discord.Interaction):
     channel_id = interaction.channel.id
     channel_name = interaction.channel.name
-    prompt = await ai.get_channel_settings(channel_id=channel_id,setting= "llm_systemprompt")
+    prompt = await get_inherited_channel_setting(interaction.channel,setting= "llm_systemprompt")
     if not prompt:
         await interaction.response.send_message(f'📝 System prompt for **#{channel_name}** has not been set.',ephemeral=True)
     else:
@@ -429,7 +640,7 @@ async def reset_system_prompt(interaction: discord.Interaction):
         await interaction.response.send_message(f'Please ask an admin to reset the 📝 system prompt for **#{channel_name}**.',ephemeral=True)
     else:
         await ai.reset_channel_setting(channel_id=channel_id,setting= "llm_systemprompt")
-        await interaction.response.send_message(f'📝 System prompt for **#{channel_name}** has been reset to the default:\n\n**{await ai.get_channel_settings(channel_id=channel_id,setting="llm_systemprompt")}**.',ephemeral=True)
+        await interaction.response.send_message(f'📝 System prompt for **#{channel_name}** has been reset to the default:\n\n**{await get_inherited_channel_setting(interaction.channel,setting="llm_systemprompt")}**.',ephemeral=True)
 
 
 
@@ -526,25 +737,12 @@ async def on_message(message):
     global ongoing_tasks
     if message.author.bot:
         return
-    
-    # if autorespond is turned off for this channel, only respond if @KittyAI is mentioned
+
+    # if autorespond is turned off for this channel, only respond if @KittyAI is mentioned.
+    # The user data is only loaded once it is clear that the bot answers
     if not await is_autorespond_enabled(message):
         if not bot.user in message.mentions:
             return
-        
-    # if the channel has set a default llm and user has access to it, use it. Else, use the default llm from the user settings
-    selected_llm = None
-    channel_llm = await ai.get_channel_settings(channel_id=message.channel.id,setting= "llm_default_model")
-    user_llm = await ai.get_user_settings(user_id=message.author.id,setting= "llm_default_model")
-    if channel_llm and await ai.user_has_access_to_llm(user_id=message.author.id, llm=channel_llm):
-        selected_llm = channel_llm
-    elif user_llm and await ai.user_has_access_to_llm(user_id=message.author.id, llm=user_llm):
-        selected_llm = user_llm
-    else:
-        if not await ai.get_user_settings(user_id=message.author.id,setting= "user_informed_about_missing_llm"):
-            await message.author.send(f'It seems you haven\'t setup an LLM (large language model) yet, to chat with me. Please use the command `/setup_llm_...` and the name of the LLM you want to use.')
-            await ai.update_user_setting(user_id=message.author.id,setting= "user_informed_about_missing_llm",new_value=True)
-        return
 
     if message.content.lower() in ["ok", "thanks", "stop"]:
         if str(message.author.id) in ongoing_tasks:
@@ -552,13 +750,30 @@ async def on_message(message):
             del ongoing_tasks[str(message.author.id)]
         return
 
+    # load everything needed to answer the message once (see get_request_context)
+    context = await get_request_context(message)
+    context.activate()
+
+    # the model is selected in the request context: the channel default llm if the user has access to it, else the user default llm
+    if not context.selected_model:
+        if not context.get_user_setting("user_informed_about_missing_llm"):
+            await message.author.send(f'It seems you haven\'t setup an LLM (large language model) yet, to chat with me. Please use the command `/setup_llm_...` and the name of the LLM you want to use.')
+            await ai.update_user_setting(user_id=message.author.id,setting= "user_informed_about_missing_llm",new_value=True)
+        return
+
     if str(message.author.id) in ongoing_tasks:
         ongoing_tasks[str(message.author.id)].cancel()
 
+    # the monthly budgets are checked before any request is sent (the thread name and the answer), a cheaper model may be used instead
+    context.selected_model, budget_error = ai.check_budget(context,context.selected_model)
+    if budget_error:
+        await message.channel.send(budget_error)
+        return
+
     task = asyncio.create_task(
         ask(
             message=message,
-            llm=selected_llm
+            context=context
             )
     )
     ongoing_tasks[str(message.author.id)] = task
@@ -574,16 +789,21 @@ async def on_message(message):
         if str(message.author.id) in ongoing_tasks:
             del ongoing_tasks[str(message.author.id)]
 
+        ai.log("on_message(): storage lookups for this message: "+str(context.storage_lookups))
+
 
 @bot.event
 async def on_ready():
     print(f'{bot.user} has connected to Discord!')
     await bot.tree.sync()
+    # load the tokenizers now, instead of during the first message
+    await asyncio.to_thread(ai.warm_up)
 
-# Run the bot
+# Run the bot (kittyai.py starts it, importing this module doesn't)
 def run_bot():
     
     bot.run(DISCORD_BOT_TOKEN)
     
 
-run_bot()
\ No newline at end of file
+if __name__ == "__main__":
+    run_bot()
@@ -1,93 +1,521 @@
-import openai
-import os
+import aiohttp
+import asyncio
+import cachetools
+import hashlib
 import json
-import traceback
+import os
 import time
+import traceback
+import weakref
 import tiktoken
+from collections import deque
+from core import retry
+from core.retry import RetryPolicy
+from core.rate_limiter import RateLimiter
 
 # list all functions for the OpenAI AP
 default_allowed_tokens = 1000
 
+# one HTTP session (with a pool of keep-alive connections) is shared by all requests.
+# The API key is sent with every request, so concurrent requests of different users never share a key.
+session = None
+session_loop = None
+max_connections = 100
+request_timeout = aiohttp.ClientTimeout(total=600,sock_connect=10)
+# rate limits, 5xx errors and timeouts are retried before the answer starts streaming
+retry_policy = RetryPolicy(name="OpenAI",deadline=90.0)
+# requests per key wait in line for the requests / tokens per minute of the key, instead of running into rate limits
+rate_limiter = RateLimiter()
+# if there is another model to fall back to, rate limits are not retried (the router switches to the next model instead)
+failover_retry_policy = RetryPolicy(name="OpenAI",budgets={"rate_limit": 0},deadline=30.0)
+
+
+class OpenAIError(Exception):
+    def __init__(self,message,status=None,retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class RateLimitError(OpenAIError):
+    pass
+
+
+def get_session():
+    # the session is bound to the event loop it was created in, so create a new one if the loop changed
+    global session, session_loop
+    loop = asyncio.get_running_loop()
+    if session is None or session.closed or session_loop is not loop:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max_connections,keepalive_timeout=60),
+            timeout=request_timeout
+        )
+        session_loop = loop
+    return session
+
+async def close_session():
+    global session
+    if session and not session.closed:
+        await session.close()
+    session = None
+
+def get_api_base():
+    # OPENAI_API_BASE points the bot to another server with the same API (e.g. tools/fake_openai_server.py).
+    # It is read at request time, so it can be set in .env (loaded after this module is imported)
+    return os.getenv("OPENAI_API_BASE","https://api.openai.com/v1").rstrip("/")
+
+def get_headers(key):
+    return {
+        "Authorization": "Bearer "+key,
+        "Content-Type": "application/json"
+    }
+
+async def raise_for_error(response):
+    # turn an error response of the API into an OpenAIError (RateLimitError for 429)
+    if response.status < 400:
+        return
+    try:
+        error = (await response.json())["error"]["message"]
+    except Exception:
+        error = await response.text()
+    retry_after = response.headers.get("Retry-After")
+    error_class = RateLimitError if response.status == 429 else OpenAIError
+    raise error_class(f"{response.status}: {error}",status=response.status,retry_after=retry_after)
+
+async def create_chat_completion_stream(key,**params):
+    # sends the request and checks the status before returning, so errors (e.g. rate limits) are raised here
+    # and not while the response is being sent. Returns an async iterator over the chunks.
+    response = await get_session().post(get_api_base()+"/chat/completions",headers=get_headers(key),json=dict(params,stream=True))
+    try:
+        await raise_for_error(response)
+    except:
+        response.release()
+        raise
+    return iterate_stream(response)
+
+async def iterate_stream(response):
+    # the API sends server-sent events: "data: {chunk}" lines, ending with "data: [DONE]"
+    try:
+        async for line in response.content:
+            line = line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            yield json.loads(data)
+    finally:
+        response.release()
+
+
+# display names of the models (as saved in the settings) and their API names
+model_names = {
+    "OpenAI gpt-4": "gpt-4",
+    "OpenAI gpt-3.5-turbo": "gpt-3.5-turbo",
+}
+
+# tokens a model can handle, the prompt and the answer together
+context_windows = {
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 4096,
+}
+# every message has a few tokens for the role and formatting
+tokens_per_message = 4
+# the prompt has to leave room for an answer of at least this many tokens
+min_answer_tokens = 500
+
+def get_context_window(model):
+    return context_windows.get(model_names.get(model,model),min(context_windows.values()))
+
+def get_max_tokens(prompt_tokens,model,max_tokens=None):
+    # tokens left for the answer after the prompt, at most max_tokens
+    space_left = get_context_window(model)-prompt_tokens
+    return min(max_tokens,space_left) if max_tokens else space_left
+
+# tokenizer encodings by API model name, loaded once (see warm_up_encodings)
+encodings = {}
+# token counts by (encoding, hash of the text), so messages that are read again every turn are not encoded again
+token_counts = cachetools.LRUCache(maxsize=20000)
+
+def get_encoding(model_name="OpenAI gpt-4"):
+    model_name = model_names.get(model_name,model_name or "gpt-4")
+    if model_name not in encodings:
+        try:
+            encodings[model_name] = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encodings[model_name] = tiktoken.get_encoding("cl100k_base")
+    return encodings[model_name]
+
+def warm_up_encodings():
+    # load the encodings of all models (downloaded on first use), called when the bot starts
+    for model_name in model_names.values():
+        get_encoding(model_name)
+
+def token_count_key(encoding,text):
+    return (encoding.name,hashlib.blake2b(text.encode("utf-8"),digest_size=16).digest())
+
 def count_tokens(message, model_name="OpenAI gpt-4"):
-    if model_name == "OpenAI gpt-4":
-        model_name = "gpt-4"
-    elif model_name == "OpenAI gpt-3.5-turbo":
-        model_name = "gpt-3.5-turbo"
-    encoding = tiktoken.encoding_for_model(model_name)
-    return len(encoding.encode(message))
+    encoding = get_encoding(model_name)
+    key = token_count_key(encoding,message)
+    if key not in token_counts:
+        token_counts[key] = len(encoding.encode_ordinary(message))
+    return token_counts[key]
+
+def count_tokens_batch(texts, model_name="OpenAI gpt-4"):
+    # count the tokens of many texts (e.g. a whole message history), only texts that are not cached are encoded (in one batch)
+    encoding = get_encoding(model_name)
+    keys = [token_count_key(encoding,text) for text in texts]
+    missing = {}
+    for key, text in zip(keys,texts):
+        if key not in token_counts:
+            missing[key] = text
+    if missing:
+        for key, tokens in zip(missing,encoding.encode_ordinary_batch(list(missing.values()))):
+            token_counts[key] = len(tokens)
+    return [token_counts[key] for key in keys]
+
+####################
+## Model router
+####################
+
+# the models that are used for each task, in the order they are tried (the faster and cheaper ones last).
+# The requested model (e.g. chosen by the user or channel) comes first, followed by the models after it. A model is skipped while it is rate limited, while its p95 latency
+# (until the answer starts) is above latency_slo seconds, or while its error rate is above max_error_rate.
+task_policies = {
+    "answer": {"models": ["gpt-4","gpt-3.5-turbo"], "latency_slo": 15.0, "max_error_rate": 0.5},
+    "summarize": {"models": ["gpt-3.5-turbo"], "latency_slo": 10.0, "max_error_rate": 0.5},
+    "thread_name": {"models": ["gpt-3.5-turbo"], "latency_slo": 10.0, "max_error_rate": 0.5},
+}
+
+
+class ModelStats:
+    # latencies and errors of the last requests (at most window, not older than max_age seconds,
+    # so a model that is skipped because it was slow or failing is used again later)
+    def __init__(self,window=100,max_age=300.0):
+        self.max_age = max_age
+        self.latencies = deque(maxlen=window)
+        self.errors = deque(maxlen=window)
+        self.rate_limited_until = 0.0
+
+    def add_latency(self,latency):
+        self.latencies.append((time.monotonic(),latency))
+        self.add_result(False)
+
+    def add_result(self,error):
+        self.errors.append((time.monotonic(),1 if error else 0))
+
+    def recent(self,samples):
+        oldest = time.monotonic()-self.max_age
+        return [value for timestamp, value in samples if timestamp >= oldest]
+
+    def num_latencies(self):
+        return len(self.recent(self.latencies))
+
+    def num_results(self):
+        return len(self.recent(self.errors))
+
+    def percentile(self,percent):
+        latencies = sorted(self.recent(self.latencies))
+        if not latencies:
+            return None
+        return latencies[min(len(latencies)-1,int(len(latencies)*percent/100))]
+
+    def error_rate(self):
+        errors = self.recent(self.errors)
+        return sum(errors)/len(errors) if errors else 0.0
+
+
+class ModelRouter:
+    def __init__(self,policies=None,min_samples=5,debug=False):
+        self.policies = policies or task_policies
+        # stats are only used once a model has this many requests
+        self.min_samples = min_samples
+        # skipped models and fallbacks are always printed, the requested model being used only in debug mode
+        self.debug = debug
+        self.stats = {}
+
+    def get_stats(self,key,model):
+        stats_id = (RateLimiter.hash_key(key),model)
+        if stats_id not in self.stats:
+            self.stats[stats_id] = ModelStats()
+        return self.stats[stats_id]
+
+    def record_success(self,key,model,latency):
+        self.get_stats(key,model).add_latency(latency)
+
+    def record_error(self,key,model,exception):
+        # only errors of the provider count (rate limits, server errors, timeouts, connection errors),
+        # not invalid requests like a prompt that is too long
+        if retry.classify(exception) is None:
+            return
+        stats = self.get_stats(key,model)
+        stats.add_result(True)
+        if isinstance(exception,RateLimitError):
+            stats.rate_limited_until = time.monotonic()+(retry.get_retry_after(exception) or 20.0)
+
+    def get_candidates(self,task,model):
+        # the requested model first, then the models after it in the task policy (never a slower or more expensive one)
+        models = self.policies.get(task,self.policies["answer"])["models"]
+        if not model:
+            return list(models)
+        if model in models:
+            return models[models.index(model):]
+        return [model]+models
+
+    def is_healthy(self,task,key,model):
+        # returns (healthy, reason)
+        policy = self.policies.get(task,self.policies["answer"])
+        stats = self.get_stats(key,model)
+        if stats.rate_limited_until > time.monotonic():
+            return False, f"rate limited for {stats.rate_limited_until-time.monotonic():.0f}s"
+        if stats.num_latencies() >= self.min_samples:
+            p50, p95 = stats.percentile(50), stats.percentile(95)
+            if p95 > policy["latency_slo"]:
+                return False, f"p95 latency {p95:.1f}s (p50 {p50:.1f}s) is above the SLO of {policy['latency_slo']}s"
+        if stats.num_results() >= self.min_samples and stats.error_rate() > policy["max_error_rate"]:
+            return False, f"error rate {stats.error_rate():.0%}"
+        return True, "healthy"
+
+    def route(self,task,key,model=None):
+        # returns the models to try, the first one is the chosen one
+        candidates = self.get_candidates(task,model)
+        healthy = []
+        for candidate in candidates:
+            is_healthy, reason = self.is_healthy(task,key,candidate)
+            if is_healthy:
+                healthy.append(candidate)
+            else:
+                print(f"Model router: task {task}, skipping {candidate}: {reason}")
+        if not healthy:
+            print(f"Model router: task {task}, no healthy model, using {candidates[0]}")
+            return candidates
+        reason = "requested model" if healthy[0] == model else f"fallback for {model}" if model else "task policy"
+        if self.debug or healthy[0] != model:
+            print(f"Model router: task {task}, chose {healthy[0]} ({reason})")
+        return healthy
+
+    def get_report(self,key=None):
+        # p50/p95 latency and error rate per key hash and model, only the models used with key if given
+        key_hash = RateLimiter.hash_key(key) if key else None
+        return {
+            stats_hash[:8]+"/"+model: {"p50": stats.percentile(50), "p95": stats.percentile(95), "error_rate": stats.error_rate(), "requests": stats.num_results()}
+            for (stats_hash, model), stats in self.stats.items()
+            if key_hash is None or stats_hash == key_hash
+        }
+
+
+router = ModelRouter()
+
 
 def get_costs(tokens_used, model_name="gpt-4"):
     prices_per_token = {
         "gpt-4": 0.06/1000,
         "gpt-3.5-turbo": 0.002/1000,
     }
-    return tokens_used * prices_per_token[model_name]
+    return tokens_used * prices_per_token.get(model_names.get(model_name,model_name),0)
 
-async def api_key_gpt_4_valid(key):
-    try:
-        openai.api_key = key
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": "Respond: Ok"}]
-            )
-        if response.choices[0].message['content']:
-            return True
-        else:
+async def api_key_valid(key,model):
+    # the cheapest check: getting the model only works with a valid key that has access to the model (no tokens are used).
+    # Returns False for invalid keys or models without access, raises OpenAIError for other errors (e.g. rate limits)
+    async with get_session().get(get_api_base()+"/models/"+model,headers=get_headers(key)) as response:
+        if response.status in (401,403,404):
             return False
-    except Exception as e:
-        return False
+        await raise_for_error(response)
+        return True
+
+async def api_key_gpt_4_valid(key):
+    return await api_key_valid(key,"gpt-4")
 
 async def api_key_gpt_3_5_turbo_valid(key):
+    return await api_key_valid(key,"gpt-3.5-turbo")
+
+class LLMStream:
+    # the response of get_llm_response: an async iterator over the text deltas of the answer
+    # usage (prompt_tokens, completion_tokens, total_tokens) is set once the stream is finished
+    # cached is True if the answer is replayed from the response cache
+    def __init__(self,chunks=None,model=None,messages=None,text=None,error=False,cached=False):
+        self.chunks = chunks
+        self.model = model
+        self.messages = messages or []
+        self.content = text or ""
+        self.error = error
+        self.cached = cached
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        self.finished = chunks is None
+        # async functions called with the stream when it has been read completely
+        self.finish_callbacks = []
+        # functions called with the stream and every delta, while the answer is read
+        self.delta_callbacks = []
+
+    def add_finish_callback(self,callback):
+        self.finish_callbacks.append(callback)
+
+    def add_delta_callback(self,callback):
+        self.delta_callbacks.append(callback)
+
+    async def __aiter__(self):
+        if self.chunks is None:
+            # a complete text (e.g. an error message)
+            if self.content:
+                yield self.content
+            return
+        async for chunk in self.chunks:
+            if chunk.get("usage"):
+                self.usage = chunk["usage"]
+            if chunk.get("choices"):
+                delta = chunk["choices"][0].get("delta",{}).get("content")
+                if delta:
+                    self.content += delta
+                    for callback in self.delta_callbacks:
+                        try:
+                            callback(self,delta)
+                        except Exception as e:
+                            print(f"Error occurred in stream callback: {e}")
+                    yield delta
+        self.finished = True
+        if not self.usage["total_tokens"]:
+            # the API did not send the usage, count the tokens ourselves
+            try:
+                prompt_tokens = sum(count_tokens(message["content"] or "",self.model) for message in self.messages)
+                completion_tokens = count_tokens(self.content,self.model)
+                self.usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens+completion_tokens}
+            except Exception as e:
+                print(f"Error occurred while counting tokens: {e}")
+        for callback in self.finish_callbacks:
+            try:
+                await callback(self)
+            except Exception as e:
+                print(f"Error occurred in stream callback: {e}")
+
+    def release(self):
+        # gives back the reservation of the rate limiter (see LimitedChunks) without waiting, e.g. if the stream is never read
+        if hasattr(self.chunks,"release"):
+            self.chunks.release()
+
+    async def aclose(self):
+        # stops reading: closes the HTTP response and releases the reservation of the rate limiter, also if the stream was never read
+        if hasattr(self.chunks,"aclose"):
+            await self.chunks.aclose()
+
+    async def text(self):
+        # read the whole stream and return the complete answer
+        if not self.finished:
+            async for delta in self:
+                pass
+        return self.content
+
+    @property
+    def tokens_used(self):
+        return self.usage["total_tokens"]
+
+
+def estimate_prompt_tokens(messages,model):
     try:
-        openai.api_key = key
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": "Respond: Ok"}]
-            )
-        if response.choices[0].message['content']:
-            return True
-        else:
-            return False
+        return sum(count_tokens_batch([message["content"] or "" for message in messages],model))+tokens_per_message*len(messages)
+    except Exception:
+        # the encoding could not be loaded, about 4 characters per token
+        return sum(len(message["content"] or "") for message in messages)//4+tokens_per_message*len(messages)
+
+async def create_limited_chat_completion_stream(key,**params):
+    # waits for the rate limiter of the key, the reservation is kept until the answer has been streamed
+    limiter = rate_limiter.get(key,params["model"])
+    reserved_tokens = await limiter.acquire(estimate_prompt_tokens(params["messages"],params["model"])+params.get("max_tokens",0))
+    started = time.monotonic()
+    try:
+        chunks = await create_chat_completion_stream(key,**params)
     except Exception as e:
-        return False
+        # the request failed before any tokens were used, the reservation is given back
+        limiter.release(reserved_tokens,0)
+        router.record_error(key,params["model"],e)
+        raise
+    except BaseException:
+        limiter.release(reserved_tokens,0)
+        raise
+    router.record_success(key,params["model"],time.monotonic()-started)
+    return LimitedChunks(chunks,limiter,reserved_tokens)
+
+class LimitedChunks:
+    # the chunks of an answer that holds a reservation of the rate limiter. The reservation is released once:
+    # when the answer has been read, when the stream is closed (also if it was never read),
+    # or when it is garbage collected without being read or closed
+    def __init__(self,chunks,limiter,reserved_tokens):
+        self.chunks = chunks
+        self.limiter = limiter
+        self.reserved_tokens = reserved_tokens
+        self.used_tokens = None
+        self.finalizer = weakref.finalize(self,limiter.release,reserved_tokens,None)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.chunks:
+                if chunk.get("usage"):
+                    self.used_tokens = chunk["usage"]["total_tokens"]
+                yield chunk
+        finally:
+            self.release()
 
-async def get_llm_response(key, messages, temperature=0.0,model="OpenAI gpt-4",max_tokens=3000):
-    openai.api_key = key
-    max_retries = 5
-    retries = 0
+    def release(self):
+        # detach() only returns the finalizer the first time, so the reservation isn't released twice
+        if self.finalizer.detach():
+            self.limiter.release(self.reserved_tokens,self.used_tokens)
 
-    if model == "OpenAI gpt-4" or model == "gpt-4":
-        model = "gpt-4"
-    else:
-        model = "gpt-3.5-turbo"
+    async def aclose(self):
+        self.release()
+        await self.chunks.aclose()
 
-    while retries < max_retries:
+async def replay_stream(text,usage):
+    # chunks like the ones of the API for a saved answer, line by line, so it is shown like a streamed answer
+    for line in text.splitlines(keepends=True):
+        yield {"choices": [{"delta": {"content": line}}]}
+    yield {"choices": [], "usage": usage}
+
+
+def resolve_model(model):
+    # API name of a model (also for the display names in the settings), None if unknown
+    model = model_names.get(model,model)
+    return model if model in model_names.values() else None
+
+
+async def get_llm_response(key, messages, temperature=0.0,model="OpenAI gpt-4",max_tokens=3000,task="answer"):
+    # returns an LLMStream for all models
+    # the model router may choose another model for the task, if the requested model is rate limited or too slow.
+    # max_tokens is reduced to the space the prompt leaves in the context window of the model
+    requested_model = resolve_model(model)
+    if model and not requested_model:
+        print(f"Model router: unknown model {model}, using the models of the task policy")
+    models = router.route(task,key,requested_model)
+    # only send role and content (the message history also contains the Discord message ids)
+    messages = [{"role": message["role"], "content": message["content"]} for message in messages]
+    prompt_tokens = estimate_prompt_tokens(messages,models[0])
+
+    for i, model in enumerate(models):
+        is_last = i == len(models)-1
+        model_max_tokens = get_max_tokens(prompt_tokens,model,max_tokens)
+        if model_max_tokens < min(min_answer_tokens,max_tokens or min_answer_tokens):
+            # a fallback model with a smaller context window can't be used for this prompt
+            if not is_last:
+                print(f"Model router: task {task}, skipping {model}, the prompt ({prompt_tokens} tokens) is too long")
+                continue
+            error_message = f"Error occurred: the prompt ({prompt_tokens} tokens) is too long for {model}, which can handle {get_context_window(model)} tokens."
+            print(error_message)
+            return LLMStream(text=error_message,model=model,error=True)
         try:
-            response = openai.ChatCompletion.create(
+            chunks = await (retry_policy if is_last else failover_retry_policy).run(
+                create_limited_chat_completion_stream,
+                key,
                 model=model,
                 messages=messages,
-                max_tokens=max_tokens,
+                max_tokens=model_max_tokens,
                 temperature=temperature,
-                stream=True if model == "gpt-4" else False
+                stream_options={"include_usage": True}
             )
-
-            if model == "gpt-4":
-                return response, 0
-            else:
-                assistant_response = response.choices[0].message['content']
-                tokens_used = response['usage']['total_tokens']
-                return assistant_response, tokens_used
-
-        except openai.error.RateLimitError as e:
-            error_message = (f"Error occurred: {e}")
-            print(error_message)
-            retries += 1
-            if retries == max_retries:
-                return error_message, 0
-            time.sleep(5)
+            return LLMStream(chunks,model=model,messages=messages)
 
         except Exception as e:
+            if not is_last and retry.classify(e) is not None:
+                print(f"Model router: task {task}, falling back from {model} to {models[i+1]}: {e}")
+                continue
             error_message = (f"Error occurred: {e}")
             print(error_message)
-            traceback.print_exc()
-            return error_message, 0
\ No newline at end of file
+            if not isinstance(e,RateLimitError):
+                traceback.print_exc()
+            return LLMStream(text=error_message,model=model,error=True)
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import time
+import cachetools
+from core import retry
+from core.single_flight import SingleFlight
+
+# results of API key checks, so running /setup_... again or setting up several plugins with the same key
+# doesn't send the same checks again.
+# The results are stored per capability (e.g. "OpenAI gpt-4" or "YouTube") under a salted hash of the key,
+# the keys themselves are not kept. Valid keys are remembered for ttl seconds, invalid keys for invalid_ttl seconds
+# (e.g. billing may be set up a few minutes later). Errors that may go away (rate limits, used up quotas, timeouts, 5xx) are not cached,
+# the check returns None for them, so the user is asked to try again later instead of being told the key is wrong.
+
+class ValidationCache:
+    def __init__(self,ttl=24*3600,invalid_ttl=300,max_entries=10000,salt=None):
+        self.ttl = ttl
+        self.invalid_ttl = invalid_ttl
+        # a new salt every start, unless set with KITTYAI_KEY_SALT
+        self.salt = (salt or os.getenv("KITTYAI_KEY_SALT") or os.urandom(16).hex()).encode("utf-8")
+        # (capability, key hash) -> (valid, expires)
+        self.results = cachetools.LRUCache(maxsize=max_entries)
+        # the same check that is already running is not sent again
+        self.checks = SingleFlight(name="API key checks")
+        self.stats = {"hits": 0, "checks": 0}
+
+    def get_stats(self):
+        return dict(self.stats,entries=len(self.results))
+
+    def hash_key(self,*keys):
+        return hashlib.sha256(self.salt+"\0".join(keys).encode("utf-8")).hexdigest()
+
+    def get(self,capability,*keys):
+        # returns True/False if the result is known, None otherwise
+        result = self.results.get((capability,self.hash_key(*keys)))
+        if result is None or result[1] < time.monotonic():
+            return None
+        return result[0]
+
+    def set(self,capability,valid,*keys):
+        ttl = self.ttl if valid else self.invalid_ttl
+        self.results[(capability,self.hash_key(*keys))] = (valid,time.monotonic()+ttl)
+
+    async def validate(self,capability,keys,check,*args):
+        # returns if keys are valid for capability, or None if they could not be checked right now.
+        # check(*args) returns True/False, or raises an exception (errors that may go away are not cached, others count as invalid)
+        valid = self.get(capability,*keys)
+        if valid is not None:
+            self.stats["hits"] += 1
+            return valid
+        return await self.checks.run((capability,self.hash_key(*keys)),self.run_check,capability,keys,check,args)
+
+    async def run_check(self,capability,keys,check,args):
+        self.stats["checks"] += 1
+        try:
+            valid = bool(await check(*args))
+        except Exception as e:
+            if retry.classify(e):
+                print(f"Could not check the API key for {capability}: {e}")
+                return None
+            valid = False
+        self.set(capability,valid,*keys)
+        return valid
+
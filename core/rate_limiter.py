@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import time
+
+# client-side limits for the requests sent with one API key, so a key shared by a whole server
+# doesn't run into rate limits (429) of the API during peaks.
+# Every key (and model) has a maximum number of requests at the same time, and token buckets for
+# requests per minute and tokens per minute. Callers wait in line (first come, first served) instead of failing.
+
+# limits per model, can be changed with RateLimiter(limits=...)
+default_limits = {
+    "gpt-4": {"max_concurrent": 8, "rpm": 200, "tpm": 40000},
+    "gpt-3.5-turbo": {"max_concurrent": 16, "rpm": 3500, "tpm": 90000},
+}
+
+
+class TokenBucket:
+    def __init__(self,capacity,per_seconds=60.0):
+        self.capacity = capacity
+        self.rate = capacity/per_seconds
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,self.tokens+(now-self.updated)*self.rate)
+        self.updated = now
+
+    def time_until(self,amount):
+        # seconds until amount tokens are available
+        self.refill()
+        return max(0.0,(amount-self.tokens)/self.rate)
+
+    def consume(self,amount):
+        self.refill()
+        self.tokens -= amount
+
+    def give_back(self,amount):
+        self.refill()
+        self.tokens = min(self.capacity,self.tokens+amount)
+
+
+class KeyLimiter:
+    def __init__(self,max_concurrent,rpm,tpm):
+        self.concurrency = asyncio.Semaphore(max_concurrent)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # asyncio.Lock wakes up waiting callers in the order they came, only the first one in line waits for the buckets
+        self.queue = asyncio.Lock()
+        self.waiting = 0
+
+    async def acquire(self,tokens):
+        # wait until a request with about this many tokens (prompt + max_tokens) can be sent
+        # requests larger than the whole budget are allowed once the bucket is full, instead of waiting forever
+        tokens = min(tokens,self.tokens.capacity)
+        self.waiting += 1
+        try:
+            async with self.queue:
+                await self.concurrency.acquire()
+                try:
+                    while True:
+                        delay = max(self.requests.time_until(1),self.tokens.time_until(tokens))
+                        if delay <= 0:
+                            break
+                        await asyncio.sleep(delay)
+                except BaseException:
+                    # e.g. the caller was cancelled while waiting for the buckets, give the slot back
+                    self.concurrency.release()
+                    raise
+                self.requests.consume(1)
+                self.tokens.consume(tokens)
+        finally:
+            self.waiting -= 1
+        return tokens
+
+    def release(self,reserved_tokens=0,used_tokens=None):
+        # called when the request is finished. Tokens that were reserved but not used are given back.
+        self.concurrency.release()
+        if used_tokens is not None and used_tokens < reserved_tokens:
+            self.tokens.give_back(reserved_tokens-used_tokens)
+
+
+class RateLimiter:
+    def __init__(self,limits=None):
+        self.limits = limits or default_limits
+        self.key_limiters = {}
+
+    @staticmethod
+    def hash_key(key):
+        # the API keys are not kept in memory as dictionary keys
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+    def get(self,key,model):
+        limiter_id = (self.hash_key(key),model)
+        if limiter_id not in self.key_limiters:
+            limits = self.limits.get(model) or next(iter(self.limits.values()))
+            self.key_limiters[limiter_id] = KeyLimiter(**limits)
+        return self.key_limiters[limiter_id]
+
+    def get_stats(self):
+        # number of callers waiting per key hash and model
+        return {key_hash[:8]+"/"+model: limiter.waiting for (key_hash, model), limiter in self.key_limiters.items()}
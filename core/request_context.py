@@ -0,0 +1,50 @@
+import contextvars
+
+# everything KittyAI needs to know to answer one message (settings, API keys, model), loaded once when the message comes in
+# and then passed through the whole pipeline, instead of every step loading it again
+
+# the context of the message that is currently processed (asyncio tasks inherit it from the task that created them)
+current_request = contextvars.ContextVar("current_request",default=None)
+
+
+def count_storage_lookup():
+    # called by KittyAIapi every time something is loaded from the storage, to see how many lookups one message needs
+    context = current_request.get()
+    if context:
+        context.storage_lookups += 1
+
+
+class RequestContext:
+    def __init__(self,user_id,channel_id,parent_channel_id=None,guild_id=None):
+        self.user_id = str(user_id)
+        # the channel (or thread) the message was sent in
+        self.message_channel_id = str(channel_id)
+        self.parent_channel_id = str(parent_channel_id) if parent_channel_id else None
+        self.guild_id = str(guild_id) if guild_id else None
+        # the channel the settings are saved for. For threads without own settings this is the parent channel
+        self.channel_id = self.message_channel_id
+        # ChannelSettings record, inherited from thread -> channel -> guild -> default channel settings
+        self.channel_settings = None
+        # UserSettings record (None if the user never saved a setting)
+        self.user_settings = None
+        self.user_secrets = {}
+        self.capabilities = frozenset()
+        self.selected_model = None
+        # the model that passed the budget check (see KittyAIapi.check_budget), it is not checked again for the same message
+        self.budget_checked_model = None
+        self.storage_lookups = 0
+
+    def get_channel_setting(self,setting):
+        return self.channel_settings.get(setting) if self.channel_settings else None
+
+    def get_user_setting(self,setting):
+        if self.user_settings is None:
+            return None
+        return self.user_settings.get(setting)
+
+    def get_api_key(self,key_type):
+        return self.user_secrets.get(key_type) or None
+
+    def activate(self):
+        # make this the context of the current task (and all tasks created from it)
+        return current_request.set(self)
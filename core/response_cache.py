@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import cachetools
+import helpertools
+
+# cache for the answers of deterministic requests (temperature 0), e.g. the same question with the same system prompt
+# in a support channel, or the same first message for get_thread_name.
+# The answers are kept in memory (least recently used are removed first, and after ttl seconds),
+# optionally also on disk (one file per answer in disk_path), so they survive a restart.
+# Expired files are removed, and every prune_interval stores the oldest files above max_disk_entries
+# (by last use, a disk hit updates the modification time of the file).
+
+class ResponseCache:
+    def __init__(self,max_entries=1000,ttl=24*3600,disk_path=None,max_disk_entries=10000,prune_interval=100):
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        self.prune_interval = prune_interval
+        self.memory = cachetools.TTLCache(maxsize=max_entries,ttl=ttl)
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "disk_removed": 0}
+        # the disk is pruned with the first store after a start (files of the last run may have expired), then every prune_interval stores
+        self.stores_since_prune = prune_interval
+        self.prune_task = None
+
+    @staticmethod
+    def get_key(model,temperature,messages,max_tokens=None):
+        # messages are normalized, so differences in whitespace don't create new entries
+        normalized = [[message["role"]," ".join((message["content"] or "").split())] for message in messages]
+        data = json.dumps([model,float(temperature or 0.0),max_tokens,normalized],ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_disk_file(self,key):
+        return os.path.join(self.disk_path,key[:2],key+".json")
+
+    def read_disk(self,key):
+        path = self.get_disk_file(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError,ValueError):
+            return None
+        if time.time()-entry.get("created",0) > self.ttl:
+            self.remove_disk_file(path)
+            return None
+        try:
+            # the modification time is the last use, the least recently used files are pruned first
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def remove_disk_file(self,path):
+        try:
+            os.remove(path)
+            self.stats["disk_removed"] += 1
+        except OSError:
+            pass
+
+    def prune_disk(self):
+        # runs in a worker thread: remove the expired files, then the least recently used above max_disk_entries
+        files = []
+        now = time.time()
+        for folder, _, names in os.walk(self.disk_path):
+            for name in names:
+                path = os.path.join(folder,name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # the age of the answer is only known by reading the file, the modification time is at least as new
+                if now-stat.st_mtime > self.ttl:
+                    self.remove_disk_file(path)
+                elif name.endswith(".json"):
+                    files.append((stat.st_mtime,path))
+        if self.max_disk_entries is not None and len(files) > self.max_disk_entries:
+            files.sort()
+            for _, path in files[:len(files)-self.max_disk_entries]:
+                self.remove_disk_file(path)
+
+    async def run_prune_disk(self):
+        try:
+            await asyncio.to_thread(self.prune_disk)
+        except Exception as e:
+            print(f"Error occurred while pruning the response cache: {e}")
+
+    def schedule_prune_disk(self):
+        self.stores_since_prune += 1
+        if self.stores_since_prune < self.prune_interval or self.prune_task and not self.prune_task.done():
+            return
+        self.stores_since_prune = 0
+        self.prune_task = asyncio.get_running_loop().create_task(self.run_prune_disk())
+
+    async def get(self,key):
+        # returns {"text", "usage"} or None
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry
+        if self.disk_path:
+            entry = await asyncio.to_thread(self.read_disk,key)
+            if entry is not None:
+                self.stats["disk_hits"] += 1
+                self.memory[key] = entry
+                return entry
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self,key,text,usage):
+        entry = {"text": text, "usage": dict(usage), "created": time.time()}
+        self.memory[key] = entry
+        self.stats["stores"] += 1
+        if self.disk_path:
+            await asyncio.to_thread(helpertools.write_file_atomic,self.get_disk_file(key),json.dumps(entry))
+            self.schedule_prune_disk()
+
+    def hit_rate(self):
+        requests = self.stats["hits"]+self.stats["disk_hits"]+self.stats["misses"]
+        return (self.stats["hits"]+self.stats["disk_hits"])/requests if requests else 0.0
+
+    def get_stats(self):
+        return dict(self.stats,entries=len(self.memory),hit_rate=self.hit_rate())
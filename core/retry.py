@@ -0,0 +1,131 @@
+import asyncio
+import email.utils
+import json
+import random
+import time
+
+# retry policy for calls to external APIs (OpenAI, Google).
+# Waits with asyncio.sleep (the bot keeps running while waiting), with exponential backoff, jitter and a maximum delay.
+# A Retry-After hint of the server is used instead of the backoff. Only rate limits, server errors (5xx),
+# timeouts and connection errors are retried, each error class with its own number of retries,
+# and never longer than the deadline of the whole call.
+# A used up daily quota is not retried, but it is an error that goes away (e.g. for the checks of API keys).
+
+default_budgets = {
+    "rate_limit": 5,
+    "server": 3,
+    "timeout": 2,
+    "connection": 2,
+    "quota": 0
+}
+
+# reasons of the Google APIs that are sent with HTTP 403 instead of 429
+google_rate_limit_reasons = ("rateLimitExceeded","userRateLimitExceeded")
+google_quota_reasons = ("quotaExceeded","dailyLimitExceeded")
+
+
+def get_status(exception):
+    # the HTTP status of an error, for the errors of aiohttp / api_openai (status), googleapiclient (resp.status)
+    # and googlemaps (status_code, or status like "OVER_QUERY_LIMIT")
+    for attribute in ("status","status_code"):
+        status = getattr(exception,attribute,None)
+        if status is not None:
+            return status
+    response = getattr(exception,"resp",None)
+    return getattr(response,"status",None)
+
+
+def get_reasons(exception):
+    # the reasons of a googleapiclient error (HttpError), e.g. ["quotaExceeded"], from the JSON body of the response
+    try:
+        error = json.loads(exception.content.decode("utf-8"))["error"]
+        return [detail.get("reason") for detail in error.get("errors",[])+error.get("details",[]) if isinstance(detail,dict)]
+    except (AttributeError,TypeError,ValueError,KeyError):
+        return []
+
+
+def get_retry_after(exception):
+    # seconds the server asked us to wait (Retry-After header as seconds or HTTP date), or None
+    retry_after = getattr(exception,"retry_after",None)
+    if retry_after is None:
+        response = getattr(exception,"resp",None)
+        if response is not None and hasattr(response,"get"):
+            retry_after = response.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0,float(retry_after))
+    except (TypeError,ValueError):
+        pass
+    try:
+        return max(0.0,email.utils.parsedate_to_datetime(retry_after).timestamp()-time.time())
+    except (TypeError,ValueError):
+        return None
+
+
+def classify(exception):
+    # returns the error class used for the retry budgets, or None if the error should not be retried
+    status = get_status(exception)
+    if status in (429,"429","OVER_QUERY_LIMIT"):
+        return "rate_limit"
+    if status in (403,"403"):
+        reasons = get_reasons(exception)
+        if any(reason in google_rate_limit_reasons for reason in reasons):
+            return "rate_limit"
+        if any(reason in google_quota_reasons for reason in reasons):
+            return "quota"
+    try:
+        if int(status) >= 500:
+            return "server"
+    except (TypeError,ValueError):
+        pass
+    # aiohttp timeouts are subclasses of asyncio.TimeoutError
+    if isinstance(exception,(asyncio.TimeoutError,TimeoutError)):
+        return "timeout"
+    if isinstance(exception,ConnectionError) or type(exception).__name__ in ("ClientConnectionError","ClientConnectorError","ServerDisconnectedError","Timeout"):
+        return "connection"
+    return None
+
+
+class RetryPolicy:
+    def __init__(self,name="retry",budgets=None,base_delay=1.0,max_delay=30.0,multiplier=2.0,jitter=True,deadline=60.0):
+        self.name = name
+        self.budgets = dict(default_budgets,**(budgets or {}))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        # seconds the whole call (including all retries) may take, None for no deadline
+        self.deadline = deadline
+
+    def get_delay(self,attempt,retry_after=None):
+        if retry_after is not None:
+            # wait as long as the server asked, plus a little jitter so waiting clients don't all retry at once
+            return retry_after + (random.uniform(0,0.1*retry_after+0.1) if self.jitter else 0)
+        delay = min(self.max_delay,self.base_delay*self.multiplier**attempt)
+        # "full jitter": a random delay between 0 and the backoff
+        return random.uniform(0,delay) if self.jitter else delay
+
+    async def run(self,func,*args,**kwargs):
+        # await func(*args,**kwargs) and retry it according to the policy. The last error is raised if retrying stops.
+        started = time.monotonic()
+        retries = {}
+        attempt = 0
+        while True:
+            try:
+                return await func(*args,**kwargs)
+            except Exception as e:
+                error_class = classify(e)
+                if error_class is None:
+                    raise
+                retries[error_class] = retries.get(error_class,0)+1
+                if retries[error_class] > self.budgets.get(error_class,0):
+                    print(f"{self.name}: giving up after {retries[error_class]-1} retries for {error_class}: {e}")
+                    raise
+                delay = self.get_delay(attempt,get_retry_after(e))
+                if self.deadline is not None and time.monotonic()-started+delay > self.deadline:
+                    print(f"{self.name}: giving up, retrying in {delay:.1f}s would exceed the deadline of {self.deadline}s: {e}")
+                    raise
+                print(f"{self.name}: {error_class} ({e}), retry {retries[error_class]}/{self.budgets[error_class]} in {delay:.1f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
@@ -0,0 +1,155 @@
+# compact records for channel and user settings
+# a record only stores the settings that differ from the defaults (as __slots__, without a dict per record),
+# the defaults are shared on the class. Values are validated when they are set or loaded.
+
+import copy
+
+
+def copy_default(value):
+    return copy.deepcopy(value) if isinstance(value,(list,dict,set)) else value
+
+
+class SettingsRecord:
+    __slots__ = ()
+    # set by KittyAIapi via set_defaults()
+    defaults = {}
+    log = None
+
+    def __init__(self,overrides=None):
+        if overrides:
+            for setting, value in overrides.items():
+                self.set(setting,value)
+
+    @classmethod
+    def set_defaults(cls,defaults,log=None):
+        # log(message,failure=False) reports invalid saved settings, e.g. KittyAIapi.log
+        cls.defaults = defaults
+        if log:
+            cls.log = staticmethod(log)
+
+    @classmethod
+    def from_dict(cls,data,strict=False):
+        # create a record from saved settings. Invalid values are skipped (the default is used instead), unless strict is True
+        record = cls()
+        for setting, value in data.items():
+            try:
+                record.set(setting,value)
+            except ValueError:
+                if strict:
+                    raise
+                message = "Skipped invalid "+cls.__name__+" setting "+str(setting)+"="+str(value)
+                if cls.log:
+                    cls.log(message,failure=True)
+                else:
+                    print(message)
+        return record
+
+    @classmethod
+    def validate(cls,setting,value):
+        # the type of the default value defines which values are valid
+        if setting not in cls.__slots__:
+            raise ValueError("Unknown setting: "+str(setting))
+        default = cls.defaults.get(setting)
+        if default is None or value is None:
+            return value
+        if isinstance(default,bool):
+            if isinstance(value,bool):
+                return value
+        elif isinstance(default,float):
+            if isinstance(value,(int,float)) and not isinstance(value,bool):
+                return float(value)
+        elif isinstance(default,int):
+            if isinstance(value,int) and not isinstance(value,bool):
+                return value
+        elif isinstance(default,(list,tuple)):
+            if isinstance(value,(list,tuple)):
+                return list(value)
+        elif isinstance(value,type(default)):
+            return value
+        raise ValueError("Invalid value for "+str(setting)+": "+str(value))
+
+    def __getattr__(self,setting):
+        # only called if the slot is not set, so the default is returned.
+        # Mutable defaults (e.g. the list of plugins) are copied, so changing the value doesn't change the defaults of all records
+        defaults = type(self).defaults
+        if setting in defaults:
+            return copy_default(defaults[setting])
+        raise AttributeError(setting)
+
+    def get(self,setting,default=None):
+        try:
+            return getattr(self,setting)
+        except AttributeError:
+            return default
+
+    def set(self,setting,value):
+        setattr(self,setting,self.validate(setting,value))
+
+    def reset(self,setting):
+        # returns False if the setting was not set
+        try:
+            delattr(self,setting)
+            return True
+        except AttributeError:
+            return False
+
+    def is_set(self,setting):
+        try:
+            object.__getattribute__(self,setting)
+            return True
+        except AttributeError:
+            return False
+
+    def overrides(self):
+        # only the settings that have been set, used to save the record
+        return {setting: object.__getattribute__(self,setting) for setting in self.__slots__ if self.is_set(setting)}
+
+    def to_dict(self):
+        # all settings, including the defaults
+        settings = {setting: copy_default(value) for setting, value in type(self).defaults.items()}
+        settings.update(self.overrides())
+        return settings
+
+    def merged(self,*records):
+        # returns a new record with the overrides of the given records applied on top of this one
+        merged = type(self)()
+        for record in (self,)+records:
+            if record:
+                for setting, value in record.overrides().items():
+                    setattr(merged,setting,value)
+        return merged
+
+    def __repr__(self):
+        return type(self).__name__+"("+str(self.overrides())+")"
+
+
+class ChannelSettings(SettingsRecord):
+    __slots__ = (
+        "location",
+        "timezone",
+        "language",
+        "llm_systemprompt",
+        "llm_creativity",
+        "llm_default_model",
+        "autorespond",
+        "num_of_last_messages_included",
+        "plugins",
+        "debug_mode",
+        "llm_response_cache",
+        "monthly_token_budget",
+        "monthly_cost_budget_eur",
+        "budget_exceeded_action"
+    )
+
+
+class UserSettings(SettingsRecord):
+    __slots__ = (
+        "location",
+        "timezone",
+        "language",
+        "llm_default_model",
+        "user_informed_about_missing_llm",
+        "monthly_token_budget",
+        "monthly_cost_budget_eur",
+        "budget_exceeded_action"
+    )
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import zlib
+import helpertools
+from core.settings_records import ChannelSettings
+
+# keeps the channel settings in memory. Reads are served from memory,
+# writes mark the store as dirty and are flushed to disk shortly after (multiple writes are combined into one flush)
+#
+# the settings are split into shards (channel_settings/shard_<number>.json) by a hash of the channel id,
+# so a change only rewrites one small shard instead of the settings of every channel.
+# Shards are loaded the first time one of their channels is used. In memory every channel is a ChannelSettings record.
+
+class ChannelSettingsStore:
+    def __init__(self,folder="channel_settings",num_shards=256,flush_delay=1.0,legacy_path="channel_settings.json"):
+        self.folder = folder
+        self.num_shards = num_shards
+        self.shards = {}
+        self.dirty_shards = set()
+        self.flusher = helpertools.DelayedFlush(self.flush,self.flush_now,flush_delay)
+        self.load_meta()
+        self.import_legacy_file(legacy_path)
+
+    def load_meta(self):
+        # the number of shards must never change once shards have been written, so it is saved next to them
+        meta_path = os.path.join(self.folder,"shards.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.num_shards = json.load(f)["num_shards"]
+        else:
+            helpertools.write_file_atomic(meta_path,json.dumps({"num_shards":self.num_shards}))
+
+    def import_legacy_file(self,legacy_path):
+        # split a channel_settings.json from older versions into shards (once), the old file is kept as .bak
+        if not legacy_path or not os.path.exists(legacy_path):
+            return
+        with open(legacy_path) as f:
+            channels = json.load(f).get("channels",{})
+        for channel_id, settings in channels.items():
+            self.shard(channel_id)[channel_id] = ChannelSettings.from_dict(settings)
+            self.dirty_shards.add(self.shard_index(channel_id))
+        self.flush_now()
+        os.replace(legacy_path,legacy_path+".bak")
+
+    ####################
+    ## Shards
+    ####################
+
+    def shard_index(self,channel_id):
+        # crc32 instead of hash(), because hash() of strings changes every time python starts
+        return zlib.crc32(str(channel_id).encode()) % self.num_shards
+
+    def shard_path(self,index):
+        return os.path.join(self.folder,"shard_"+str(index).zfill(3)+".json")
+
+    def load_shard(self,index):
+        if index not in self.shards:
+            path = self.shard_path(index)
+            if os.path.exists(path):
+                # settings are validated once, when the shard is loaded
+                with open(path) as f:
+                    self.shards[index] = {channel_id: ChannelSettings.from_dict(settings) for channel_id, settings in json.load(f).items()}
+            else:
+                self.shards[index] = {}
+        return self.shards[index]
+
+    def shard(self,channel_id):
+        return self.load_shard(self.shard_index(channel_id))
+
+    def export(self):
+        # load all shards and return the custom settings of all channels
+        channels = {}
+        for index in range(self.num_shards):
+            for channel_id, settings in self.load_shard(index).items():
+                channels[channel_id] = settings.overrides()
+        return channels
+
+    ####################
+    ## Settings
+    ####################
+
+    def exists(self,channel_id):
+        return str(channel_id) in self.shard(channel_id)
+
+    def get(self,channel_id):
+        # returns the ChannelSettings record of the channel or None
+        return self.shard(channel_id).get(str(channel_id))
+
+    def set(self,channel_id,setting,new_value):
+        self.update(channel_id,{setting:new_value})
+
+    def update(self,channel_id,new_settings):
+        # validate all values first, so invalid values don't leave half applied changes
+        new_settings = {setting: ChannelSettings.validate(setting,value) for setting, value in new_settings.items()}
+        shard = self.shard(channel_id)
+        if str(channel_id) not in shard:
+            shard[str(channel_id)] = ChannelSettings()
+        for setting, value in new_settings.items():
+            shard[str(channel_id)].set(setting,value)
+        self.schedule_flush(channel_id)
+
+    def delete(self,channel_id,setting=None):
+        # delete a single setting or (if setting is None) all settings of a channel
+        # returns False if there was nothing to delete
+        channel_id = str(channel_id)
+        shard = self.shard(channel_id)
+        if channel_id not in shard:
+            return False
+        if setting is None:
+            del shard[channel_id]
+        elif not shard[channel_id].reset(setting):
+            return False
+        self.schedule_flush(channel_id)
+        return True
+
+    ####################
+    ## Flushing
+    ####################
+
+    def serialize(self,index):
+        # only the custom settings are saved
+        return json.dumps({channel_id: settings.overrides() for channel_id, settings in self.shards[index].items()},indent=4)
+
+    def schedule_flush(self,channel_id):
+        self.dirty_shards.add(self.shard_index(channel_id))
+        self.flusher.schedule()
+
+    async def flush(self):
+        # keep flushing until no new changes came in while writing. Only changed shards are written.
+        while self.dirty_shards:
+            index = self.dirty_shards.pop()
+            data = self.serialize(index)
+            await asyncio.to_thread(helpertools.write_file_atomic,self.shard_path(index),data)
+
+    def flush_now(self):
+        while self.dirty_shards:
+            index = self.dirty_shards.pop()
+            helpertools.write_file_atomic(self.shard_path(index),self.serialize(index))
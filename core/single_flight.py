@@ -0,0 +1,127 @@
+import asyncio
+import core.api_openai as api_openai
+
+# identical requests that run at the same time (e.g. the same event delivered twice, or several users asking the same)
+# are only sent once: the first caller starts the request, everyone else waits for the same result.
+# Streamed answers (LLMStream) are shared with SharedStream, every caller gets an own stream with all deltas.
+
+
+class SharedStream:
+    def __init__(self,stream):
+        self.stream = stream
+        self.deltas = []
+        self.finished = False
+        self.changed = asyncio.Condition()
+        self.done_callbacks = []
+        self.subscribers = 0
+        # subscribers that have not finished reading or been cancelled, when the last one is gone the request is stopped
+        self.listeners = 0
+        # the answer is read in an own task, so a slow or cancelled caller doesn't hold up the others
+        self.pump_task = None if stream.error else asyncio.ensure_future(self.pump())
+        if self.pump_task:
+            self.pump_task.add_done_callback(self.pump_done)
+
+    async def pump(self):
+        try:
+            async for delta in self.stream:
+                async with self.changed:
+                    self.deltas.append(delta)
+                    self.changed.notify_all()
+        except Exception as e:
+            print(f"Error occurred while reading a shared stream: {e}")
+        finally:
+            # closes the HTTP response and releases the rate limiter if the stream was stopped before the end
+            try:
+                await self.stream.aclose()
+            except Exception as e:
+                print(f"Error occurred while closing a shared stream: {e}")
+            async with self.changed:
+                self.finished = True
+                self.changed.notify_all()
+            for callback in self.done_callbacks:
+                callback()
+
+    def pump_done(self,task):
+        # a pump that is cancelled before it started never runs its finally block
+        if not self.finished:
+            self.stream.release()
+            self.finished = True
+            for callback in self.done_callbacks:
+                callback()
+
+    def stop(self):
+        # nobody reads the answer anymore (e.g. the user said "stop"), don't let the model generate the rest
+        if self.pump_task and not self.pump_task.done():
+            print("Shared stream: all subscribers are gone, stopping the request")
+            self.pump_task.cancel()
+
+    def on_done(self,callback):
+        if self.stream.error or self.finished:
+            callback()
+        else:
+            self.done_callbacks.append(callback)
+
+    async def iterate(self):
+        # all deltas so far, then the new ones as they arrive, and the usage at the end
+        index = 0
+        try:
+            while True:
+                async with self.changed:
+                    while index >= len(self.deltas) and not self.finished:
+                        await self.changed.wait()
+                    deltas = self.deltas[index:]
+                    finished = self.finished
+                for delta in deltas:
+                    yield {"choices": [{"delta": {"content": delta}}]}
+                index += len(deltas)
+                if finished and index >= len(self.deltas):
+                    break
+            yield {"choices": [], "usage": self.stream.usage}
+        finally:
+            # the subscriber finished, or was cancelled / closed before the end
+            self.listeners -= 1
+            if self.listeners <= 0 and not self.finished:
+                self.stop()
+
+    def subscribe(self):
+        # returns a new LLMStream for a caller. Only the first caller's request spent tokens, the others are marked as cached
+        self.subscribers += 1
+        cached = self.stream.cached or self.subscribers > 1
+        if self.stream.error:
+            return api_openai.LLMStream(text=self.stream.content,model=self.stream.model,error=True)
+        # counted from here (not when reading starts), so a subscriber that starts reading later still gets the whole answer
+        self.listeners += 1
+        return api_openai.LLMStream(self.iterate(),model=self.stream.model,messages=self.stream.messages,cached=cached)
+
+
+class SingleFlight:
+    def __init__(self,name="single flight"):
+        self.name = name
+        self.in_flight = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    async def run(self,key,func,*args,**kwargs):
+        # await func(*args,**kwargs), or the call with the same key that is already running.
+        # The result is shared by all callers, a SharedStream stays in flight until it is finished.
+        self.stats["calls"] += 1
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.call(key,func,args,kwargs))
+            self.in_flight[key] = task
+        else:
+            self.stats["coalesced"] += 1
+            print(f"{self.name}: joined a request that is already running")
+        # shield: if one caller is cancelled, the request continues for the others
+        return await asyncio.shield(task)
+
+    async def call(self,key,func,args,kwargs):
+        try:
+            result = await func(*args,**kwargs)
+        except BaseException:
+            self.in_flight.pop(key,None)
+            raise
+        if isinstance(result,SharedStream):
+            result.on_done(lambda: self.in_flight.pop(key,None))
+        else:
+            self.in_flight.pop(key,None)
+        return result
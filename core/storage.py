@@ -0,0 +1,462 @@
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import helpertools
+from dotenv import dotenv_values
+from core.settings_store import ChannelSettingsStore
+from core.settings_records import ChannelSettings, UserSettings
+
+# storage backends for everything KittyAI saves: channel settings, user settings, user secrets (API keys) and user history
+# "files" keeps the file layout (channel_settings/shard_<number>.json, user_settings/<id>.json, user_secrets/<id>.env, user_history/<id>.json)
+# "sqlite" saves everything in one SQLite database (WAL mode), with one row per channel/user and setting
+
+
+def get_storage(backend=None,path=None):
+    # select the backend via the KITTYAI_STORAGE env variable ("files" or "sqlite"), default is "files"
+    backend = backend or os.getenv("KITTYAI_STORAGE","files")
+    if backend == "files":
+        return FileStorage(path or ".")
+    elif backend == "sqlite":
+        return SQLiteStorage(path or os.getenv("KITTYAI_SQLITE_PATH","kittyai.db"))
+    else:
+        raise ValueError("Unknown storage backend: "+str(backend)+". Accepted values are 'files' and 'sqlite'.")
+
+
+class StorageBackend:
+    # all backends implement these functions. Settings are ChannelSettings/UserSettings records (only the custom settings),
+    # history is a dict and secrets are dicts of strings.
+
+    ####################
+    ## Channel settings
+    ####################
+
+    async def channel_settings_exist(self,channel_id):
+        raise NotImplementedError
+
+    async def get_channel_settings(self,channel_id):
+        # returns the ChannelSettings record of the channel or None
+        raise NotImplementedError
+
+    async def update_channel_setting(self,channel_id,setting,new_value):
+        raise NotImplementedError
+
+    async def update_channel_settings(self,channel_id,new_settings):
+        # update multiple settings with a single write
+        raise NotImplementedError
+
+    async def reset_channel_setting(self,channel_id,setting):
+        # returns False if the setting was not set
+        raise NotImplementedError
+
+    async def reset_channel_settings(self,channel_id):
+        # returns False if the channel had no settings
+        raise NotImplementedError
+
+    ####################
+    ## User settings
+    ####################
+
+    async def get_user_settings(self,user_id):
+        # returns the UserSettings record of the user or None
+        raise NotImplementedError
+
+    async def save_user_settings(self,user_id,user_settings):
+        # replace all settings of a user (dict of custom settings)
+        raise NotImplementedError
+
+    async def update_user_settings(self,user_id,new_settings):
+        # update one or more settings of a user
+        raise NotImplementedError
+
+    async def reset_user_settings(self,user_id):
+        raise NotImplementedError
+
+    ####################
+    ## User secrets
+    ####################
+
+    async def get_user_secrets(self,user_id):
+        # returns all secrets of the user (empty dict if none are set)
+        raise NotImplementedError
+
+    async def set_user_secret(self,user_id,key_type,key):
+        raise NotImplementedError
+
+    async def delete_user_secret(self,user_id,key_type):
+        raise NotImplementedError
+
+    ####################
+    ## User history
+    ####################
+
+    async def get_user_history(self,user_id):
+        # returns the saved history of the user or None
+        raise NotImplementedError
+
+    async def save_user_history(self,user_id,user_history):
+        raise NotImplementedError
+
+    ####################
+    ## Requests
+    ####################
+
+    async def load_request_data(self,channel_ids,user_id):
+        # load everything needed to answer one message in one go:
+        # ({channel_id: custom settings or None}, user settings or None, user secrets)
+        channel_settings = {}
+        for channel_id in channel_ids:
+            channel_settings[str(channel_id)] = await self.get_channel_settings(channel_id)
+        return channel_settings, await self.get_user_settings(user_id), await self.get_user_secrets(user_id)
+
+    ####################
+    ## Migration
+    ####################
+
+    # used by migrate_storage.py, each returns a dict with all entries: {id: custom settings/secrets/history dict}
+    def export_channel_settings(self):
+        raise NotImplementedError
+
+    def export_user_settings(self):
+        raise NotImplementedError
+
+    def export_user_secrets(self):
+        raise NotImplementedError
+
+    def export_user_history(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+####################
+## Files
+####################
+
+class FileStorage(StorageBackend):
+    def __init__(self,path="."):
+        self.path = path
+        self.user_settings_folder = os.path.join(path,"user_settings")
+        self.user_secrets_folder = os.path.join(path,"user_secrets")
+        self.user_history_folder = os.path.join(path,"user_history")
+        # parsed .env files per user: {user_id: (file version, secrets)}. The file version (mtime + size)
+        # makes sure changes to the .env files from outside of KittyAI are picked up as well
+        self.user_secrets_cache = {}
+        # user settings are written by one task at a time per user. Changes that come in while a write is running
+        # are collected in pending_user_settings and saved together with the next write
+        self.user_settings_locks = {}
+        self.pending_user_settings = {}
+        # channel settings are loaded once and served from memory
+        self.channel_settings_store = ChannelSettingsStore(
+            folder=os.path.join(path,"channel_settings"),
+            legacy_path=os.path.join(path,"channel_settings.json")
+            )
+
+    def user_file(self,folder,user_id,extension):
+        return os.path.join(folder,str(user_id)+extension)
+
+    def load_json(self,path):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save_json(self,path,data):
+        helpertools.write_file_atomic(path,json.dumps(data,indent=4))
+
+    async def run_file_task(self,function,*args):
+        # file access runs in a worker thread, to not block the event loop.
+        # At exit no new threads can be started (e.g. when UsageLedger.flush_now saves the usage), then it runs directly
+        try:
+            return await asyncio.to_thread(function,*args)
+        except RuntimeError:
+            return function(*args)
+
+    def save_env(self,path,env_values):
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,"w") as f:
+            for k, v in env_values.items():
+                f.write(f"{k}=\"{v}\"\n")
+
+    def export_folder(self,folder,extension,load):
+        entries = {}
+        if os.path.exists(folder):
+            for filename in os.listdir(folder):
+                if filename.endswith(extension):
+                    entries[filename[:-len(extension)]] = load(os.path.join(folder,filename))
+        return entries
+
+    # Channel settings
+
+    async def channel_settings_exist(self,channel_id):
+        return self.channel_settings_store.exists(channel_id)
+
+    async def get_channel_settings(self,channel_id):
+        return self.channel_settings_store.get(channel_id)
+
+    async def update_channel_setting(self,channel_id,setting,new_value):
+        self.channel_settings_store.set(channel_id,setting,new_value)
+
+    async def update_channel_settings(self,channel_id,new_settings):
+        self.channel_settings_store.update(channel_id,new_settings)
+
+    async def reset_channel_setting(self,channel_id,setting):
+        return self.channel_settings_store.delete(channel_id,setting)
+
+    async def reset_channel_settings(self,channel_id):
+        return self.channel_settings_store.delete(channel_id)
+
+    def export_channel_settings(self):
+        return self.channel_settings_store.export()
+
+    # User settings
+
+    def user_settings_lock(self,user_id):
+        if user_id not in self.user_settings_locks:
+            self.user_settings_locks[user_id] = asyncio.Lock()
+        return self.user_settings_locks[user_id]
+
+    def apply_user_settings(self,path,new_settings):
+        # runs in a worker thread: load the settings file, apply the changes and write it back (only custom settings are saved)
+        user_settings = UserSettings.from_dict(self.load_json(path) or {})
+        for setting, value in new_settings.items():
+            user_settings.set(setting,value)
+        helpertools.write_file_atomic(path,json.dumps(user_settings.overrides(),indent=4))
+
+    def load_user_settings(self,path):
+        user_settings = self.load_json(path)
+        return UserSettings.from_dict(user_settings) if user_settings is not None else None
+
+    async def get_user_settings(self,user_id):
+        # file access runs in a worker thread, to not block the event loop
+        return await asyncio.to_thread(self.load_user_settings,self.user_file(self.user_settings_folder,user_id,".json"))
+
+    async def save_user_settings(self,user_id,user_settings):
+        user_id = str(user_id)
+        path = self.user_file(self.user_settings_folder,user_id,".json")
+        async with self.user_settings_lock(user_id):
+            await asyncio.to_thread(helpertools.write_file_atomic,path,json.dumps(user_settings,indent=4))
+
+    async def update_user_settings(self,user_id,new_settings):
+        user_id = str(user_id)
+        path = self.user_file(self.user_settings_folder,user_id,".json")
+        new_settings = {setting: UserSettings.validate(setting,value) for setting, value in new_settings.items()}
+        self.pending_user_settings.setdefault(user_id,{}).update(copy.deepcopy(new_settings))
+        async with self.user_settings_lock(user_id):
+            new_settings = self.pending_user_settings.pop(user_id,None)
+            if new_settings is None:
+                # the changes have already been saved by a write that was waiting for the lock before us
+                return
+            await asyncio.to_thread(self.apply_user_settings,path,new_settings)
+
+    async def reset_user_settings(self,user_id):
+        user_id = str(user_id)
+        path = self.user_file(self.user_settings_folder,user_id,".json")
+        async with self.user_settings_lock(user_id):
+            self.pending_user_settings.pop(user_id,None)
+            if os.path.exists(path):
+                await asyncio.to_thread(os.remove,path)
+
+    def export_user_settings(self):
+        return self.export_folder(self.user_settings_folder,".json",self.load_json)
+
+    # User secrets
+
+    def file_version(self,path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns,stat.st_size)
+
+    async def get_user_secrets(self,user_id):
+        user_id = str(user_id)
+        path = self.user_file(self.user_secrets_folder,user_id,".env")
+        version = self.file_version(path)
+        if version is None:
+            self.user_secrets_cache.pop(user_id,None)
+            return {}
+        cached = self.user_secrets_cache.get(user_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        # parse the .env file without loading it into os.environ, secrets of different users must not mix
+        secrets = dict(dotenv_values(path))
+        self.user_secrets_cache[user_id] = (version,secrets)
+        return secrets
+
+    async def set_user_secret(self,user_id,key_type,key):
+        user_id = str(user_id)
+        path = self.user_file(self.user_secrets_folder,user_id,".env")
+        env_values = dict(await self.get_user_secrets(user_id))
+        env_values[key_type] = key
+        self.save_env(path,env_values)
+        self.user_secrets_cache[user_id] = (self.file_version(path),env_values)
+
+    async def delete_user_secret(self,user_id,key_type):
+        user_id = str(user_id)
+        path = self.user_file(self.user_secrets_folder,user_id,".env")
+        env_values = dict(await self.get_user_secrets(user_id))
+        if key_type in env_values:
+            del env_values[key_type]
+            self.save_env(path,env_values)
+            self.user_secrets_cache[user_id] = (self.file_version(path),env_values)
+
+    def export_user_secrets(self):
+        return self.export_folder(self.user_secrets_folder,".env",lambda path: dict(dotenv_values(path)))
+
+    # User history
+
+    async def get_user_history(self,user_id):
+        return await self.run_file_task(self.load_json,self.user_file(self.user_history_folder,user_id,".json"))
+
+    async def save_user_history(self,user_id,user_history):
+        await self.run_file_task(self.save_json,self.user_file(self.user_history_folder,user_id,".json"),copy.deepcopy(user_history))
+
+    def export_user_history(self):
+        return self.export_folder(self.user_history_folder,".json",self.load_json)
+
+    def close(self):
+        self.channel_settings_store.flush_now()
+
+
+####################
+## SQLite
+####################
+
+class SQLiteStorage(StorageBackend):
+    tables = ["channel_settings","user_settings","user_secrets","user_history"]
+
+    def __init__(self,path="kittyai.db"):
+        self.path = path
+        # secrets per user, only changed through set_user_secret / delete_user_secret: {user_id: secrets}
+        self.user_secrets_cache = {}
+        self.db = sqlite3.connect(path,isolation_level=None,check_same_thread=False)
+        # WAL lets reads continue while a write is in progress, NORMAL sync is safe in WAL mode
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # one row per (channel/user, key). The primary key is the index used for all lookups.
+        self.db.execute("CREATE TABLE IF NOT EXISTS channel_settings (channel_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (channel_id, key)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (user_id, key)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS user_secrets (user_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (user_id, key)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS user_history (user_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (user_id, key)) WITHOUT ROWID")
+
+    def load_rows(self,table,row_id,decode=json.loads):
+        # returns {key: value} for one channel/user, or None if no rows exist
+        id_column = "channel_id" if table == "channel_settings" else "user_id"
+        rows = self.db.execute(f"SELECT key, value FROM {table} WHERE {id_column} = ?",(str(row_id),)).fetchall()
+        if not rows:
+            return None
+        return {key: decode(value) for key, value in rows}
+
+    def replace_rows(self,table,row_id,values,encode=json.dumps):
+        # replace all rows of one channel/user in a single transaction
+        id_column = "channel_id" if table == "channel_settings" else "user_id"
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(f"DELETE FROM {table} WHERE {id_column} = ?",(str(row_id),))
+            self.db.executemany(
+                f"INSERT INTO {table} ({id_column}, key, value) VALUES (?, ?, ?)",
+                [(str(row_id),key,encode(value)) for key, value in values.items()]
+                )
+
+    def export_table(self,table,decode=json.loads):
+        id_column = "channel_id" if table == "channel_settings" else "user_id"
+        entries = {}
+        for row_id, key, value in self.db.execute(f"SELECT {id_column}, key, value FROM {table}"):
+            entries.setdefault(row_id,{})[key] = decode(value)
+        return entries
+
+    # Channel settings
+
+    async def channel_settings_exist(self,channel_id):
+        return self.db.execute("SELECT 1 FROM channel_settings WHERE channel_id = ? LIMIT 1",(str(channel_id),)).fetchone() is not None
+
+    async def get_channel_settings(self,channel_id):
+        channel_settings = self.load_rows("channel_settings",channel_id)
+        return ChannelSettings.from_dict(channel_settings) if channel_settings is not None else None
+
+    async def update_channel_setting(self,channel_id,setting,new_value):
+        self.db.execute(
+            "INSERT INTO channel_settings (channel_id, key, value) VALUES (?, ?, ?) ON CONFLICT (channel_id, key) DO UPDATE SET value = excluded.value",
+            (str(channel_id),str(setting),json.dumps(ChannelSettings.validate(setting,new_value)))
+            )
+
+    async def update_channel_settings(self,channel_id,new_settings):
+        new_settings = {setting: ChannelSettings.validate(setting,value) for setting, value in new_settings.items()}
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO channel_settings (channel_id, key, value) VALUES (?, ?, ?) ON CONFLICT (channel_id, key) DO UPDATE SET value = excluded.value",
+                [(str(channel_id),str(setting),json.dumps(value)) for setting, value in new_settings.items()]
+                )
+
+    async def reset_channel_setting(self,channel_id,setting):
+        return self.db.execute("DELETE FROM channel_settings WHERE channel_id = ? AND key = ?",(str(channel_id),str(setting))).rowcount > 0
+
+    async def reset_channel_settings(self,channel_id):
+        return self.db.execute("DELETE FROM channel_settings WHERE channel_id = ?",(str(channel_id),)).rowcount > 0
+
+    def export_channel_settings(self):
+        return self.export_table("channel_settings")
+
+    # User settings
+
+    async def get_user_settings(self,user_id):
+        user_settings = self.load_rows("user_settings",user_id)
+        return UserSettings.from_dict(user_settings) if user_settings is not None else None
+
+    async def save_user_settings(self,user_id,user_settings):
+        self.replace_rows("user_settings",user_id,user_settings)
+
+    async def update_user_settings(self,user_id,new_settings):
+        new_settings = {setting: UserSettings.validate(setting,value) for setting, value in new_settings.items()}
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT INTO user_settings (user_id, key, value) VALUES (?, ?, ?) ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value",
+                [(str(user_id),key,json.dumps(value)) for key, value in new_settings.items()]
+                )
+
+    async def reset_user_settings(self,user_id):
+        self.db.execute("DELETE FROM user_settings WHERE user_id = ?",(str(user_id),))
+
+    def export_user_settings(self):
+        return self.export_table("user_settings")
+
+    # User secrets (saved as plain strings, like in the .env files)
+
+    async def get_user_secrets(self,user_id):
+        user_id = str(user_id)
+        if user_id not in self.user_secrets_cache:
+            self.user_secrets_cache[user_id] = self.load_rows("user_secrets",user_id,decode=str) or {}
+        return self.user_secrets_cache[user_id]
+
+    async def set_user_secret(self,user_id,key_type,key):
+        self.db.execute(
+            "INSERT INTO user_secrets (user_id, key, value) VALUES (?, ?, ?) ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value",
+            (str(user_id),str(key_type),str(key))
+            )
+        self.user_secrets_cache.pop(str(user_id),None)
+
+    async def delete_user_secret(self,user_id,key_type):
+        self.db.execute("DELETE FROM user_secrets WHERE user_id = ? AND key = ?",(str(user_id),str(key_type)))
+        self.user_secrets_cache.pop(str(user_id),None)
+
+    def export_user_secrets(self):
+        return self.export_table("user_secrets",decode=str)
+
+    # User history
+
+    async def get_user_history(self,user_id):
+        return self.load_rows("user_history",user_id)
+
+    async def save_user_history(self,user_id,user_history):
+        self.replace_rows("user_history",user_id,user_history)
+
+    def export_user_history(self):
+        return self.export_table("user_history")
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+import helpertools
+
+# rolling summaries of threads, so the history of a thread doesn't have to be summarized again for every reply.
+# For every thread the summary of all messages up to a message id is saved, the next summary is created from
+# this summary and the newer messages only.
+#
+# The summaries are kept in memory and saved to a JSON file shortly after a change (multiple changes are combined).
+# Threads that have not been used for ttl seconds, and the least recently used threads above max_threads, are removed.
+
+class ThreadSummaryStore:
+    def __init__(self,path="thread_summaries.json",max_threads=2000,ttl=30*24*3600,flush_delay=5.0):
+        self.path = path
+        self.max_threads = max_threads
+        self.ttl = ttl
+        # thread id -> {"message_id", "summary", "tokens", "used"}, the least recently used thread first
+        self.summaries = OrderedDict()
+        self.dirty = False
+        self.flusher = helpertools.DelayedFlush(self.flush,self.flush_now,flush_delay)
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                summaries = json.load(f)
+        except (OSError,ValueError) as e:
+            print("Could not load thread summaries: "+str(e))
+            return
+        for thread_id, entry in sorted(summaries.items(),key=lambda item: item[1].get("used",0)):
+            self.summaries[thread_id] = entry
+        self.evict()
+
+    def get(self,thread_id):
+        # returns {"message_id", "summary", "tokens"} of the thread or None
+        thread_id = str(thread_id)
+        entry = self.summaries.get(thread_id)
+        if entry is None:
+            return None
+        if self.is_expired(entry):
+            del self.summaries[thread_id]
+            self.schedule_flush()
+            return None
+        entry["used"] = time.time()
+        self.summaries.move_to_end(thread_id)
+        return entry
+
+    def set(self,thread_id,message_id,summary,tokens=0):
+        # message_id is the id of the last message included in the summary
+        thread_id = str(thread_id)
+        self.summaries[thread_id] = {
+            "message_id": str(message_id),
+            "summary": summary,
+            "tokens": tokens,
+            "used": time.time()
+        }
+        self.summaries.move_to_end(thread_id)
+        self.evict()
+        self.schedule_flush()
+
+    def delete(self,thread_id):
+        if self.summaries.pop(str(thread_id),None) is not None:
+            self.schedule_flush()
+
+    def is_expired(self,entry):
+        return self.ttl is not None and time.time()-entry.get("used",0) > self.ttl
+
+    def evict(self):
+        evicted = False
+        # expired threads (the least recently used are first, so stop at the first one that is not expired)
+        while self.summaries and self.is_expired(next(iter(self.summaries.values()))):
+            self.summaries.popitem(last=False)
+            evicted = True
+        while len(self.summaries) > self.max_threads:
+            self.summaries.popitem(last=False)
+            evicted = True
+        if evicted:
+            self.dirty = True
+
+    ####################
+    ## Flushing
+    ####################
+
+    def serialize(self):
+        return json.dumps(self.summaries,indent=4)
+
+    def schedule_flush(self):
+        self.dirty = True
+        self.flusher.schedule()
+
+    async def flush(self):
+        while self.dirty:
+            self.dirty = False
+            data = self.serialize()
+            await asyncio.to_thread(helpertools.write_file_atomic,self.path,data)
+
+    def flush_now(self):
+        if self.dirty:
+            self.dirty = False
+            helpertools.write_file_atomic(self.path,self.serialize())
@@ -0,0 +1,258 @@
+import asyncio
+import copy
+import datetime
+import json
+import os
+import core.api_openai as api_openai
+import helpertools
+
+# counts the tokens used for every LLM request, per user, channel and model.
+# The prompt tokens are counted when the request is sent, the completion tokens while the answer is streamed
+# (so answers that are cancelled are counted too). When the stream is finished, the counts are corrected with the usage sent by the API.
+# The monthly usage of the users is saved to the user history in batches (one write per user every flush_delay seconds),
+# at the beginning of a new month the usage is moved to the past months.
+# The usage of the current month per user and per channel is also kept as counters, so budgets can be checked
+# without reading the storage (see get_month_usage). The usage per channel is saved to channel_usage_path.
+
+usd_to_eur = 0.92
+
+
+def get_month():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m")
+
+
+class UsageLedger:
+    def __init__(self,storage,default_user_history,channel_usage_path="channel_usage.json",flush_delay=30.0):
+        self.storage = storage
+        self.default_user_history = default_user_history
+        self.channel_usage_path = channel_usage_path
+        # (month, user id, channel id, model) -> {"prompt_tokens", "completion_tokens", "requests", "cost_usd"}
+        self.totals = {}
+        # user id -> {"month", "tokens", "cost_eur"} not saved to the user history yet
+        self.pending = {}
+        # usage of the current month: user id / channel id -> {"month", "tokens", "cost_eur"}
+        self.user_months = {}
+        self.channel_months = {}
+        # users whose saved usage has been added to user_months (it is loaded in the background, see load_user)
+        self.loaded_users = set()
+        self.loading_users = set()
+        self.channels_changed = False
+        # the usage is only saved from the event loop (and at exit)
+        self.flusher = helpertools.DelayedFlush(self.flush,self.flush_now,flush_delay,write_without_loop=False)
+        self.load_channels()
+
+    ####################
+    ## Counting
+    ####################
+
+    def track(self,stream,user_id,channel_id=None,prompt_tokens=None):
+        # count the usage of an LLMStream. Answers from the cache or shared with another request didn't use any tokens.
+        if stream.error or stream.cached:
+            return
+        user_id = str(user_id)
+        channel_id = str(channel_id) if channel_id else None
+        model = stream.model
+        if prompt_tokens is None:
+            prompt_tokens = api_openai.estimate_prompt_tokens(stream.messages,model)
+        counted = {"prompt_tokens": prompt_tokens, "completion_tokens": 0}
+        self.add(user_id,channel_id,model,prompt_tokens=prompt_tokens,requests=1)
+
+        def count_delta(stream,delta):
+            try:
+                tokens = api_openai.count_tokens(delta,model)
+            except Exception:
+                tokens = max(1,len(delta)//4)
+            counted["completion_tokens"] += tokens
+            self.add(user_id,channel_id,model,completion_tokens=tokens)
+
+        async def correct_with_usage(stream):
+            # the usage sent by the API is exact, only add the difference to what has been counted
+            if stream.usage["total_tokens"]:
+                self.add(
+                    user_id,
+                    channel_id,
+                    model,
+                    prompt_tokens=stream.usage["prompt_tokens"]-counted["prompt_tokens"],
+                    completion_tokens=stream.usage["completion_tokens"]-counted["completion_tokens"]
+                )
+
+        stream.add_delta_callback(count_delta)
+        stream.add_finish_callback(correct_with_usage)
+
+    def add(self,user_id,channel_id,model,prompt_tokens=0,completion_tokens=0,requests=0):
+        month = get_month()
+        tokens = prompt_tokens+completion_tokens
+        cost_usd = api_openai.get_costs(tokens,model)
+
+        total = self.totals.setdefault((month,user_id,channel_id,model),{"prompt_tokens": 0, "completion_tokens": 0, "requests": 0, "cost_usd": 0.0})
+        total["prompt_tokens"] += prompt_tokens
+        total["completion_tokens"] += completion_tokens
+        total["requests"] += requests
+        total["cost_usd"] += cost_usd
+        counters = [self.get_counter(self.user_months,user_id,month)]
+        if channel_id:
+            counters.append(self.get_counter(self.channel_months,channel_id,month))
+            self.channels_changed = True
+        for counter in counters:
+            counter["tokens"] += tokens
+            counter["cost_eur"] += cost_usd*usd_to_eur
+
+        pending = self.pending.get(user_id)
+        if pending is None or pending["month"] != month:
+            if pending is not None:
+                # a new month started before the usage of the last month was saved, keep both
+                self.pending[(user_id,pending["month"])] = pending
+            pending = self.pending[user_id] = {"month": month, "tokens": 0, "cost_eur": 0.0}
+        pending["tokens"] += tokens
+        pending["cost_eur"] += cost_usd*usd_to_eur
+        self.flusher.schedule()
+
+    @staticmethod
+    def get_counter(counters,counter_id,month):
+        # the counter of the month, a counter of a past month is reset
+        counter = counters.get(counter_id)
+        if counter is None or counter["month"] != month:
+            counter = counters[counter_id] = {"month": month, "tokens": 0, "cost_eur": 0.0}
+        return counter
+
+    def get_month_usage(self,user_id=None,channel_id=None):
+        # tokens and costs (EUR) of the current month of the user or channel, without reading the storage.
+        # The saved usage of a user is loaded with the user data of the first message (see KittyAIapi.get_request_context),
+        # if the user is looked up before that, it is loaded in the background
+        month = get_month()
+        if user_id is not None:
+            user_id = str(user_id)
+            if user_id not in self.loaded_users:
+                self.load_user_later(user_id)
+            counter = self.user_months.get(user_id)
+        else:
+            counter = self.channel_months.get(str(channel_id))
+        if counter is None or counter["month"] != month:
+            return {"month": month, "tokens": 0, "cost_eur": 0.0}
+        return counter
+
+    def get_usage(self,month=None,user_id=None,channel_id=None,model=None):
+        # sum of the usage since the bot started, filtered by month, user, channel and model
+        month = month or get_month()
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "requests": 0, "cost_usd": 0.0}
+        for (total_month, total_user, total_channel, total_model), total in self.totals.items():
+            if total_month != month or user_id and total_user != str(user_id) or channel_id and total_channel != str(channel_id) or model and total_model != model:
+                continue
+            for key in usage:
+                usage[key] += total[key]
+        return usage
+
+    ####################
+    ## Saving
+    ####################
+
+    def load_channels(self):
+        if not self.channel_usage_path or not os.path.exists(self.channel_usage_path):
+            return
+        try:
+            with open(self.channel_usage_path) as f:
+                self.channel_months = json.load(f)
+        except (OSError,ValueError) as e:
+            print("Could not load the channel usage: "+str(e))
+
+    def load_user_later(self,user_id):
+        if user_id in self.loading_users:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.loading_users.add(user_id)
+        loop.create_task(self.load_user(user_id))
+
+    async def load_user(self,user_id):
+        try:
+            user_history = await self.storage.get_user_history(user_id)
+        except Exception as e:
+            print(f"Error occurred while loading the usage of user {user_id}: {e}")
+            self.loading_users.discard(user_id)
+            return
+        self.add_saved_usage(user_id,user_history)
+
+    def add_saved_usage(self,user_id,user_history):
+        # adds the usage saved in the user history to the counter of the user (once, before new usage is saved)
+        if user_id in self.loaded_users:
+            return
+        self.loaded_users.add(user_id)
+        self.loading_users.discard(user_id)
+        month = get_month()
+        # histories saved before the month was recorded only have the usage of the current month
+        if user_history and user_history.get("month",month) == month:
+            counter = self.get_counter(self.user_months,user_id,month)
+            counter["tokens"] += user_history.get("monthly_used_tokens",0)
+            counter["cost_eur"] += user_history.get("estimated_monthly_cost_eur",0.0)
+
+    def apply_to_history(self,user_history,pending):
+        # add the pending usage to the user history, moving the usage of the past month if a new month started
+        user_history = copy.deepcopy(user_history) if user_history else copy.deepcopy(self.default_user_history)
+        month = user_history.get("month")
+        if month and month != pending["month"]:
+            if month < pending["month"]:
+                user_history.setdefault("past_months_used_tokens",[]).append({"month": month, "tokens": user_history.get("monthly_used_tokens",0)})
+                user_history.setdefault("past_months_cost_eur",[]).append({"month": month, "cost_eur": round(user_history.get("estimated_monthly_cost_eur",0.0),6)})
+                user_history["monthly_used_tokens"] = 0
+                user_history["estimated_monthly_cost_eur"] = 0.0
+                user_history["month"] = pending["month"]
+            else:
+                # usage of a past month that was saved late, add it to that month
+                for past in user_history.setdefault("past_months_used_tokens",[]):
+                    if past.get("month") == pending["month"]:
+                        past["tokens"] += pending["tokens"]
+                for past in user_history.setdefault("past_months_cost_eur",[]):
+                    if past.get("month") == pending["month"]:
+                        past["cost_eur"] = round(past["cost_eur"]+pending["cost_eur"],6)
+                return user_history
+        user_history["month"] = pending["month"]
+        user_history["monthly_used_tokens"] = user_history.get("monthly_used_tokens",0)+pending["tokens"]
+        user_history["estimated_monthly_cost_eur"] = round(user_history.get("estimated_monthly_cost_eur",0.0)+pending["cost_eur"],6)
+        return user_history
+
+    async def flush(self):
+        await self.flush_users()
+        if self.channels_changed and self.channel_usage_path:
+            self.channels_changed = False
+            try:
+                await asyncio.to_thread(helpertools.write_file_atomic,self.channel_usage_path,json.dumps(self.channel_months))
+            except Exception as e:
+                print(f"Error occurred while saving the channel usage: {e}")
+        self.prune()
+
+    async def flush_users(self):
+        # one read and one write per user with new usage
+        while self.pending:
+            pending_users = self.pending
+            self.pending = {}
+            # the usage of past months first (only exists if a month ended before it was saved)
+            for pending_id, pending in sorted(pending_users.items(),key=lambda item: item[1]["month"]):
+                user_id = pending_id[0] if isinstance(pending_id,tuple) else pending_id
+                try:
+                    user_history = await self.storage.get_user_history(user_id)
+                    self.add_saved_usage(user_id,user_history)
+                    await self.storage.save_user_history(user_id,self.apply_to_history(user_history,pending))
+                except Exception as e:
+                    print(f"Error occurred while saving the usage of user {user_id}: {e}")
+
+    def prune(self):
+        # the usage per channel and model is only kept for the current month
+        month = get_month()
+        for key in [key for key in self.totals if key[0] != month]:
+            del self.totals[key]
+        for counters in (self.user_months,self.channel_months):
+            for counter_id in [counter_id for counter_id, counter in counters.items() if counter["month"] != month]:
+                del counters[counter_id]
+
+    def flush_now(self):
+        # called at exit, when no new threads can be started: the channel usage is written directly
+        try:
+            if self.pending:
+                asyncio.run(self.flush_users())
+            if self.channels_changed and self.channel_usage_path:
+                self.channels_changed = False
+                helpertools.write_file_atomic(self.channel_usage_path,json.dumps(self.channel_months))
+        except Exception as e:
+            print(f"Error occurred while saving the usage: {e}")
@@ -1,5 +1,9 @@
 import aiohttp
+import asyncio
+import atexit
+import os
 import re
+import tempfile
 from datetime import datetime
 import pytz
 from geopy.geocoders import Nominatim
@@ -18,13 +22,17 @@ async def download_file(url):
 ## Time functions
 ####################
 
-async def location_to_timezone(location_string):
+def lookup_timezone(location_string):
     geolocator = Nominatim(user_agent="geoapiExercises")
     location = geolocator.geocode(location_string)
     tf = TimezoneFinder()
     timezone_str = tf.timezone_at(lng=location.longitude, lat=location.latitude)
     return timezone_str
 
+async def location_to_timezone(location_string):
+    # the geocoder and timezone finder are blocking, run them in a thread so the bot keeps running
+    return await asyncio.to_thread(lookup_timezone,location_string)
+
 def current_time_in_timezone(timezone_str):
     timezone = pytz.timezone(timezone_str)
     current_time = datetime.now(timezone)
@@ -36,7 +44,7 @@ async def get_date_time_location(location, timezone=None):
     # input: Berlin Kreuzberg, Germany
     # output: Now is April 30 2023, 8:02PM. In Berlin Kreuzberg, Germany.
     if timezone is None:
-        timezone = location_to_timezone(location)
+        timezone = await location_to_timezone(location)
     
     current_time = current_time_in_timezone(timezone)
 
@@ -114,4 +122,53 @@ def split_message(message, max_length):
             message_parts.append(current_part)
     
     message_parts = [item.strip() for item in message_parts if item != ""]
-    return message_parts
\ No newline at end of file
+    return message_parts
+
+
+# write a file by first writing a temp file next to it and then renaming it, so the file is never left half written
+def write_file_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # keep the permissions of the existing file (mkstemp creates files only readable by the owner)
+        os.chmod(temp_path, os.stat(path).st_mode if os.path.exists(path) else 0o644)
+        os.replace(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# combines many changes into one write: flush() runs delay seconds after the first change, changes made until then
+# are written by the same flush. flush_now() writes synchronously, it is called at exit and (if write_without_loop)
+# for changes made without a running event loop (e.g. in a script)
+class DelayedFlush:
+    def __init__(self, flush, flush_now, delay, write_without_loop=True):
+        self.flush = flush
+        self.flush_now = flush_now
+        self.delay = delay
+        self.write_without_loop = write_without_loop
+        self.task = None
+        # make sure pending changes are not lost when the bot stops
+        atexit.register(flush_now)
+
+    def schedule(self):
+        if self.task and not self.task.done():
+            # a flush is already scheduled, it will pick up this change as well
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if self.write_without_loop:
+                self.flush_now()
+            return
+        self.task = loop.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.delay)
+        await self.flush()
@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+from core.storage import get_storage
+
+# copy all channel settings, user settings, user secrets and user history from one storage backend to another
+# example: python migrate_storage.py --source files --target sqlite --target-path kittyai.db
+
+
+async def migrate(source,target):
+    counts = {}
+
+    channel_settings = source.export_channel_settings()
+    for channel_id, settings in channel_settings.items():
+        for setting, value in settings.items():
+            await target.update_channel_setting(channel_id,setting,value)
+    counts["channel settings"] = len(channel_settings)
+
+    user_settings = source.export_user_settings()
+    for user_id, settings in user_settings.items():
+        await target.save_user_settings(user_id,settings)
+    counts["user settings"] = len(user_settings)
+
+    user_secrets = source.export_user_secrets()
+    for user_id, secrets in user_secrets.items():
+        for key_type, key in secrets.items():
+            await target.set_user_secret(user_id,key_type,key)
+    counts["user secrets"] = len(user_secrets)
+
+    user_history = source.export_user_history()
+    for user_id, history in user_history.items():
+        await target.save_user_history(user_id,history)
+    counts["user history"] = len(user_history)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the KittyAI storage from one backend to another.")
+    parser.add_argument("--source",default="files",choices=["files","sqlite"])
+    parser.add_argument("--source-path",default=None,help="Folder for 'files', database file for 'sqlite'.")
+    parser.add_argument("--target",default="sqlite",choices=["files","sqlite"])
+    parser.add_argument("--target-path",default=None,help="Folder for 'files', database file for 'sqlite'.")
+    args = parser.parse_args()
+
+    if args.source == args.target and args.source_path == args.target_path:
+        parser.error("source and target are the same")
+
+    source = get_storage(args.source,args.source_path)
+    target = get_storage(args.target,args.target_path)
+    try:
+        counts = asyncio.run(migrate(source,target))
+    finally:
+        source.close()
+        target.close()
+
+    for name, count in counts.items():
+        print(f"Migrated {name}: {count}")
+
+
+if __name__ == "__main__":
+    main()
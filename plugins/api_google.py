@@ -1,41 +1,66 @@
 from googleapiclient.discovery import build
+import asyncio
 import googlemaps
+from core import retry
+from core.retry import RetryPolicy
+from core.single_flight import SingleFlight
+
+# the Google clients are synchronous, so requests run in a thread and are retried without blocking the bot
+retry_policy = RetryPolicy(name="Google",deadline=30.0)
+# identical searches that run at the same time are only sent once
+searches = SingleFlight(name="Google searches")
+
+# the checks of the API keys use the cheapest request of every API and run in a thread (the clients are synchronous).
+# They return False for keys that are not valid, errors that may go away (rate limits, used up quotas, 5xx, timeouts) are raised
+
+def raise_if_temporary(exception):
+    if retry.classify(exception):
+        raise exception
 
 async def google_search_api_keys_valid(api_key, cx_id):
-    try:
+    # custom search has no cheaper request that also checks the cx id, only one result with the search information is requested
+    def check():
         service = build("customsearch", "v1", developerKey=api_key)
-        results = service.cse().list(q="test", cx=cx_id, num=1, start=1).execute()
+        service.cse().list(q="test", cx=cx_id, num=1, fields="searchInformation").execute()
+    try:
+        await asyncio.to_thread(check)
         return True
-    except:
+    except Exception as e:
+        raise_if_temporary(e)
         return False
 
 async def youtube_api_key_valid(api_key):
-    try:
+    # listing a video by id costs 1 unit of the quota, a search costs 100
+    def check():
         youtube = build("youtube", "v3", developerKey=api_key)
-        results = youtube.search().list(
-            q="test",
-            part="id,snippet",
-            type="video",
-            maxResults=1,
-            order="relevance",
-            regionCode="US",
-            relevanceLanguage="en"
-        ).execute()
+        youtube.videos().list(part="id", id="jNQXAC9IVRw").execute()
+    try:
+        await asyncio.to_thread(check)
         return True
-    except:
+    except Exception as e:
+        raise_if_temporary(e)
         return False
-    
+
 async def google_maps_api_key_valid(api_key):
-    try:
+    # finding a place with only the place id is free, a text search is billed
+    def check():
         gmaps = googlemaps.Client(key=api_key)
-        results = gmaps.places("test")
+        gmaps.find_place("test","textquery",fields=["place_id"])
+    try:
+        await asyncio.to_thread(check)
         return True
-    except:
+    except Exception as e:
+        raise_if_temporary(e)
         return False
 
 async def search(google_api_key,google_cx_id,query,num_results=1,page=1):
+    results = await searches.run(("search",google_api_key,google_cx_id,query,num_results,page),run_search,google_api_key,google_cx_id,query,num_results,page)
+    # every caller gets its own copy of the shared results
+    return [dict(result) for result in results]
+
+async def run_search(google_api_key,google_cx_id,query,num_results=1,page=1):
     service = build("customsearch", "v1", developerKey=google_api_key)
-    results = service.cse().list(q=query, cx=google_cx_id, num=num_results, start=page).execute()
+    results = await retry_policy.run(asyncio.to_thread,service.cse().list(q=query, cx=google_cx_id, num=num_results, start=page).execute)
     return [{
         "title": item['title'],
         "description": item['snippet'],
@@ -45,7 +70,7 @@ async def search(google_api_key,google_cx_id,query,num_results=1,page=1):
 
 async def searchimages(google_api_key,google_cx_id,query,num_results=1,page=1):
     service = build("customsearch", "v1", developerKey=google_api_key)
-    results = service.cse().list(q=query, cx=google_cx_id, num=num_results, searchType="image", start=page).execute()
+    results = await retry_policy.run(asyncio.to_thread,service.cse().list(q=query, cx=google_cx_id, num=num_results, searchType="image", start=page).execute)
     return [{
         "title": item['title'],
         "image": item['link'],
@@ -58,7 +83,7 @@ async def searchimages(google_api_key,google_cx_id,query,num_results=1,page=1):
 async def searchvideos(google_api_key,query, num_results=1, page=1,order="relevance",regionCode="US",relevanceLanguage="en"):
     youtube = build("youtube", "v3", developerKey=google_api_key)
 
-    results = youtube.search().list(
+    request = youtube.search().list(
         q=query,
         part="id,snippet",
         type="video",
@@ -66,7 +91,8 @@ async def searchvideos(google_api_key,query, num_results=1, page=1,order="releva
         order=order,
         regionCode=regionCode,
         relevanceLanguage=relevanceLanguage
-    ).execute()
+    )
+    results = await retry_policy.run(asyncio.to_thread,request.execute)
 
     return [{
         "title": item['snippet']['title'],
@@ -83,7 +109,7 @@ async def searchlocations(google_api_key,query, where, open_now=False, num_resul
     if where:
         query = query+" in "+where
 
-    results = gmaps.places(query,open_now=open_now)
+    results = await retry_policy.run(asyncio.to_thread,gmaps.places,query,open_now=open_now)
 
     # return the name, photo, address, rating, link and opening hours of the results
     return [{
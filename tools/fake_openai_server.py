@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from aiohttp import web
+
+# a local stand-in for the OpenAI chat completions API, to test streaming, retries and concurrency without API keys or network.
+# start it and point KittyAI at it:
+#   python tools/fake_openai_server.py --port 8080 --chunk-delay 0.05 --rate-limit-rate 0.1
+#   OPENAI_API_BASE=http://127.0.0.1:8080/v1 python kittyai.py
+# every API key is accepted, except keys starting with "invalid" (401).
+
+words = "Kitty thinks this is a good question and here is a short answer with some words to stream back to you".split()
+
+
+class FakeOpenAI:
+    def __init__(self,args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.stats = {"requests": 0, "streams": 0, "rate_limited": 0, "server_errors": 0, "active": 0, "max_active": 0, "disconnected": 0}
+
+    def get_latency(self):
+        # seconds until the answer starts
+        if self.args.latency_distribution == "lognormal" and self.args.latency > 0:
+            return self.random.lognormvariate(0,self.args.latency_jitter)*self.args.latency
+        return max(0.0,self.args.latency+self.random.uniform(-self.args.latency_jitter,self.args.latency_jitter))
+
+    def get_answer(self,model,messages):
+        last_message = messages[-1]["content"] if messages else ""
+        answer = [f"[{model}]"]+[self.random.choice(words) for _ in range(self.args.answer_words)]
+        if self.args.echo and last_message:
+            answer += ["You","said:",last_message]
+        return " ".join(answer)
+
+    @staticmethod
+    def count_tokens(text):
+        # about one token per word, good enough for testing
+        return len((text or "").split())
+
+    def get_usage(self,messages,answer):
+        prompt_tokens = sum(self.count_tokens(message.get("content"))+4 for message in messages)
+        completion_tokens = self.count_tokens(answer)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens+completion_tokens}
+
+    def error(self,status,message,headers=None):
+        return web.json_response({"error": {"message": message, "type": "fake_error"}},status=status,headers=headers)
+
+    def check_request(self,request):
+        # returns an error response (invalid key, injected 429 or 5xx) or None
+        key = request.headers.get("Authorization","").replace("Bearer ","")
+        if not key or key.startswith("invalid"):
+            return self.error(401,"Incorrect API key provided.")
+        if self.random.random() < self.args.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return self.error(429,"Rate limit reached (fake).",headers={"Retry-After": str(self.args.retry_after)})
+        if self.random.random() < self.args.server_error_rate:
+            self.stats["server_errors"] += 1
+            return self.error(self.random.choice([500,502,503]),"The server had an error (fake).")
+        return None
+
+    async def chat_completions(self,request):
+        self.stats["requests"] += 1
+        error = self.check_request(request)
+        if error:
+            return error
+        body = await request.json()
+        model = body.get("model","gpt-3.5-turbo")
+        messages = body.get("messages",[])
+        answer = self.get_answer(model,messages)
+        usage = self.get_usage(messages,answer)
+        completion_id = "chatcmpl-"+uuid.uuid4().hex[:24]
+
+        self.stats["active"] += 1
+        self.stats["max_active"] = max(self.stats["max_active"],self.stats["active"])
+        try:
+            await asyncio.sleep(self.get_latency())
+            if not body.get("stream"):
+                return web.json_response({
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                    "usage": usage
+                })
+
+            self.stats["streams"] += 1
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            answer_words = answer.split(" ")
+            for i in range(0,len(answer_words),self.args.chunk_size):
+                content = " ".join(answer_words[i:i+self.args.chunk_size])
+                if i > 0:
+                    content = " "+content
+                await self.send_event(response,completion_id,model,[{"index": 0, "delta": {"content": content}, "finish_reason": None}])
+                await asyncio.sleep(self.args.chunk_delay)
+            await self.send_event(response,completion_id,model,[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if self.args.usage and body.get("stream_options",{}).get("include_usage"):
+                await self.send_event(response,completion_id,model,[],usage)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        except ConnectionResetError:
+            # the client stopped reading the answer (e.g. the user said "stop")
+            self.stats["disconnected"] += 1
+            return response
+        finally:
+            self.stats["active"] -= 1
+
+    async def send_event(self,response,completion_id,model,choices,usage=None):
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": choices}
+        if usage:
+            chunk["usage"] = usage
+        await response.write(b"data: "+json.dumps(chunk).encode("utf-8")+b"\n\n")
+
+    async def models(self,request):
+        error = self.check_request(request)
+        if error:
+            return error
+        return web.json_response({"object": "list", "data": [{"id": model, "object": "model"} for model in ("gpt-4","gpt-3.5-turbo")]})
+
+    async def model(self,request):
+        error = self.check_request(request)
+        if error:
+            return error
+        return web.json_response({"id": request.match_info["model"], "object": "model"})
+
+    async def get_stats(self,request):
+        return web.json_response(self.stats)
+
+
+def create_app(args):
+    fake = FakeOpenAI(args)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions",fake.chat_completions)
+    app.router.add_get("/v1/models",fake.models)
+    app.router.add_get("/v1/models/{model}",fake.model)
+    app.router.add_get("/stats",fake.get_stats)
+    return app
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server for offline testing.")
+    parser.add_argument("--host",default="127.0.0.1")
+    parser.add_argument("--port",type=int,default=8080)
+    parser.add_argument("--latency",type=float,default=0.3,help="Seconds until the answer starts.")
+    parser.add_argument("--latency-jitter",type=float,default=0.1,help="Uniform: +- seconds, lognormal: sigma.")
+    parser.add_argument("--latency-distribution",default="uniform",choices=["uniform","lognormal"])
+    parser.add_argument("--chunk-delay",type=float,default=0.03,help="Seconds between streamed chunks.")
+    parser.add_argument("--chunk-size",type=int,default=1,help="Words per streamed chunk.")
+    parser.add_argument("--answer-words",type=int,default=40)
+    parser.add_argument("--echo",action="store_true",help="Repeat the last message at the end of the answer.")
+    parser.add_argument("--rate-limit-rate",type=float,default=0.0,help="Share of requests answered with 429.")
+    parser.add_argument("--retry-after",type=float,default=1.0,help="Retry-After of the 429 responses in seconds.")
+    parser.add_argument("--server-error-rate",type=float,default=0.0,help="Share of requests answered with 5xx.")
+    parser.add_argument("--no-usage",dest="usage",action="store_false",help="Don't send usage, even if requested.")
+    parser.add_argument("--seed",type=int,default=None)
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    web.run_app(create_app(args),host=args.host,port=args.port)
+
+
+if __name__ == "__main__":
+    main()